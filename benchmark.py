@@ -0,0 +1,214 @@
+"""End-to-end benchmark of the pipeline, against mock_openai_server.py instead of the OpenAI API.
+
+A synthetic exam is generated in a temporary workspace and the three stages are run on it: p1_prepare_inputs.py
+(headless detection), p2_main.py and p3_jsons_converter.py. The results are saved as JSON in benchmark_results,
+so that runs before and after a change can be compared with --compare.
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy as np
+from PIL import Image
+
+import mock_openai_server
+
+REPO_FOLDER = os.path.dirname(os.path.abspath(__file__))
+RESULTS_FOLDER = os.path.join(REPO_FOLDER, "benchmark_results")
+
+# Run a script of the repository with the workspace as current folder, so that the p0_configuration.py of the workspace is used
+BOOTSTRAP = "import runpy, sys; sys.path.append(sys.argv[1]); sys.argv = sys.argv[2:]; runpy.run_path(sys.argv[0], run_name='__main__')"
+
+# Size of an A4 page at 200 dpi
+PAGE_SIZE = (1654, 2339)
+
+QUESTION_TEXT = [
+    "Considere a funcao f(x) = 2x + 3 definida para todo x real.",
+    "Qual e o valor de f(4) - f(1)?"
+]
+ALTERNATIVES = ["3", "6", "9", "12"]
+
+
+def draw_exam_page(page_number, questions_per_page):
+    """A page with numbered questions, each with its alternatives a) to d), as a grayscale array."""
+    width, height = PAGE_SIZE
+    page = np.full((height, width), 255, np.uint8)
+    line_height = 50
+    question_height = (len(QUESTION_TEXT) + len(ALTERNATIVES)) * line_height
+    gap = max(line_height * 2, (height - 300 - questions_per_page * question_height) // max(1, questions_per_page))
+
+    y = 150
+    for i in range(questions_per_page):
+        number = (page_number - 1) * questions_per_page + i + 1
+        lines = [f"{number}. {QUESTION_TEXT[0]}"] + ["    " + text for text in QUESTION_TEXT[1:]]
+        lines += [f"{letter}) {alternative}" for letter, alternative in zip("abcd", ALTERNATIVES)]
+        for line in lines:
+            cv2.putText(page, line, (120, y), cv2.FONT_HERSHEY_SIMPLEX, 1.1, 0, 2, cv2.LINE_AA)
+            y += line_height
+        y += gap
+    return page
+
+
+def generate_exam(folder, pages, questions_per_page, as_pdf):
+    """Write the synthetic exam into the folder, as one PDF or as one image per page."""
+    os.makedirs(folder, exist_ok=True)
+    images = [Image.fromarray(draw_exam_page(page_number, questions_per_page)) for page_number in range(1, pages + 1)]
+
+    if as_pdf:
+        images[0].save(os.path.join(folder, "exam.pdf"), save_all=True, append_images=images[1:], resolution=200)
+    else:
+        for page_number, image in enumerate(images, start=1):
+            image.save(os.path.join(folder, f"page_{page_number:03d}.png"))
+
+
+def write_configuration(workspace, port, settings):
+    lines = [
+        'API_KEY = "benchmark"',
+        'MAX_TOKENS_PER_API_CALL = 2500',
+        f'API_BASE_URL = "http://127.0.0.1:{port}/v1"'
+    ]
+    lines += [f"{name} = {value}" for name, value in settings]
+    with open(os.path.join(workspace, "p0_configuration.py"), 'w') as file:
+        file.write("\n".join(lines) + "\n")
+
+
+def run_stage(workspace, name, script, *args):
+    """Run one stage as a process of its own. Return its time, exit code and peak memory."""
+    print(f"Running {name}: {script} {' '.join(args)}")
+    with open(os.path.join(workspace, f"{name}.log"), 'w') as log:
+        start_time = time.perf_counter()
+        process = subprocess.Popen([sys.executable, "-c", BOOTSTRAP, REPO_FOLDER, os.path.join(REPO_FOLDER, script), *args],
+                                   cwd=workspace, stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT)
+
+        # wait4 gives the resource usage of this process alone
+        _, status, usage = os.wait4(process.pid, 0)
+        seconds = time.perf_counter() - start_time
+        process.returncode = os.waitstatus_to_exitcode(status)
+
+    if process.returncode != 0:
+        print(f"{name} exited with code {process.returncode}, see {name}.log in the workspace")
+    # ru_maxrss is in KB on Linux
+    return {"seconds": seconds, "exit_code": process.returncode, "peak_rss_mb": usage.ru_maxrss / 1024}
+
+
+def count_files(folder, extensions):
+    if not os.path.exists(folder):
+        return 0
+    return sum(1 for file in os.listdir(folder) if file.lower().endswith(extensions))
+
+
+def percentile(values, q):
+    return float(np.percentile(values, q)) if values else None
+
+
+def run_benchmark(args):
+    server = mock_openai_server.start_server(0, latency=args.latency, latency_jitter=args.latency_jitter,
+                                             rate_limit=args.rate_limit, malformed_rate=args.malformed_rate, seed=args.seed)
+    port = server.server_address[1]
+    workspace = tempfile.mkdtemp(prefix="benchmark_")
+    settings = [setting.split("=", 1) for setting in args.set]
+
+    try:
+        generate_exam(os.path.join(workspace, "inputs"), args.pages, args.questions_per_page, args.input == "pdf")
+        write_configuration(workspace, port, settings)
+
+        p1_args = ["--headless"] + (["--workers", str(args.workers)] if args.workers else [])
+        p2_args = ["--yes", "--no-cache"] + args.p2_args.split()
+        stages = {
+            "p1": run_stage(workspace, "p1", "p1_prepare_inputs.py", *p1_args),
+            "p2": run_stage(workspace, "p2", "p2_main.py", *p2_args),
+            "p3": run_stage(workspace, "p3", "p3_jsons_converter.py", "--pdf", "native")
+        }
+
+        crops = count_files(os.path.join(workspace, "output_0_areas"), (".jpg", ".png", ".webp"))
+        questions = count_files(os.path.join(workspace, "output_1_jsons"), (".json",))
+        stats = server.state.statistics()
+
+        # The cost estimated by p2_main.py, with the price of the model of each request
+        cost = None
+        metrics_path = os.path.join(workspace, "api_responses", "metrics.json")
+        if os.path.exists(metrics_path):
+            with open(metrics_path, 'r') as file:
+                cost = json.load(file)["cost_usd"]
+
+        metrics = {
+            "crops": crops,
+            "crops_per_second": crops / stages["p1"]["seconds"],
+            "questions_solved": questions,
+            "requests": stats["requests"],
+            "requests_per_minute": stats["requests"] / stages["p2"]["seconds"] * 60,
+            "rate_limited_requests": stats["rate_limited"],
+            "malformed_answers": stats["malformed"],
+            "latency_p50": percentile(stats["latencies"], 50),
+            "latency_p95": percentile(stats["latencies"], 95),
+            "prompt_tokens": stats["prompt_tokens"],
+            "completion_tokens": stats["completion_tokens"],
+            "cost_equivalent_usd": cost,
+            "peak_rss_mb": max(stage["peak_rss_mb"] for stage in stages.values()),
+            "total_seconds": sum(stage["seconds"] for stage in stages.values())
+        }
+    finally:
+        server.shutdown()
+        if args.keep:
+            print(f"Workspace kept in {workspace}")
+        else:
+            shutil.rmtree(workspace, ignore_errors=True)
+
+    return {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "settings": {
+            "input": args.input, "pages": args.pages, "questions_per_page": args.questions_per_page, "workers": args.workers,
+            "p2_args": args.p2_args, "latency": args.latency, "latency_jitter": args.latency_jitter,
+            "rate_limit": args.rate_limit, "malformed_rate": args.malformed_rate, "seed": args.seed, "configuration": dict(settings)
+        },
+        "stages": stages,
+        "metrics": metrics
+    }
+
+
+def print_metrics(result, previous=None):
+    for name, value in result["metrics"].items():
+        line = f"{name:>24}: {value if value is None else round(value, 3)}"
+        old_value = previous["metrics"].get(name) if previous else None
+        if old_value:
+            line += f"  ({(value - old_value) / old_value * 100:+.1f}% from {round(old_value, 3)})"
+        print(line)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline end to end against the mock OpenAI API.")
+    parser.add_argument("--input", choices=["images", "pdf"], default="pdf", help="generate the exam as one PDF (needs poppler) or as images")
+    parser.add_argument("--pages", type=int, default=5)
+    parser.add_argument("--questions-per-page", type=int, default=4)
+    parser.add_argument("--workers", type=int, default=None, help="processes of the automatic detection")
+    parser.add_argument("--p2-args", default="", help="extra arguments of p2_main.py, e.g. --p2-args=\"--async --max-in-flight 32\"")
+    parser.add_argument("--set", action="append", default=[], metavar="NAME=VALUE", help="add a constant to p0_configuration.py, e.g. MAX_WORKERS=16")
+    parser.add_argument("--latency", type=float, default=0.5, help="seconds the mock takes to answer each completion")
+    parser.add_argument("--latency-jitter", type=float, default=0.5, help="random extra latency of the mock, up to this many seconds")
+    parser.add_argument("--rate-limit", type=int, default=None, help="chat requests per minute before the mock answers 429")
+    parser.add_argument("--malformed-rate", type=float, default=0, help="fraction of the completions with broken JSON")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--keep", action="store_true", help="keep the workspace with the outputs and logs of the stages")
+    parser.add_argument("--compare", default=None, help="results JSON of an earlier run to compare with")
+    args = parser.parse_args()
+
+    result = run_benchmark(args)
+
+    os.makedirs(RESULTS_FOLDER, exist_ok=True)
+    result_path = os.path.join(RESULTS_FOLDER, f"benchmark_{time.strftime('%Y%m%d_%H%M%S')}.json")
+    with open(result_path, 'w') as file:
+        json.dump(result, file, indent=4)
+
+    previous = None
+    if args.compare:
+        with open(args.compare, 'r') as file:
+            previous = json.load(file)
+    print_metrics(result, previous)
+    print(f"\nResults saved in {result_path}")
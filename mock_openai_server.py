@@ -0,0 +1,340 @@
+"""Local stand-in for the OpenAI API, to run the pipeline without an API key or costs.
+
+Run `python3 mock_openai_server.py` and set API_BASE_URL = "http://127.0.0.1:8000/v1" in p0_configuration.py.
+The latency, a rate limit and broken answers can be simulated to test the pipeline under the conditions of the real API.
+"""
+import argparse
+import base64
+import io
+import itertools
+import math
+import json
+import random
+import threading
+import time
+from collections import deque
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from PIL import Image
+
+# Answer given to every question
+MOCK_QUESTION = {
+    "enunciado": "Quanto é 2 + 2?",
+    "tipo": "Objetiva",
+    "resposta": {
+        "a": {"alternativa": "3", "textoExplicativo": "3 é menor do que a soma."},
+        "b": {"alternativa": "4", "textoExplicativo": "2 + 2 = 4."},
+        "alternativaCorreta": "B"
+    }
+}
+
+
+def image_tokens(image_url):
+    """Tokens the API charges for an image: 85, plus 170 per 512px tile of the resized image in high detail."""
+    if image_url.get("detail") == "low":
+        return 85
+    try:
+        with Image.open(io.BytesIO(base64.b64decode(image_url["url"].split(",", 1)[1]))) as image:
+            width, height = image.size
+    except Exception:
+        return 85
+
+    # Fit in 2048 x 2048, then make the shortest side at most 768
+    scale = min(1, 2048 / max(width, height))
+    scale *= min(1, 768 / (min(width, height) * scale))
+    return 85 + 170 * math.ceil(width * scale / 512) * math.ceil(height * scale / 512)
+
+
+def completion_body(payload):
+    """Build a chat completion in the format of the API, with a rough token usage."""
+    parts = [part for message in payload.get("messages", []) if isinstance(message.get("content"), list) for part in message["content"]]
+
+    # Requests with several images (see p2_packing.py) get one question per image
+    images = [part["image_url"] for part in parts if part.get("type") == "image_url"]
+    answer = [MOCK_QUESTION] * len(images) if len(images) > 1 else MOCK_QUESTION
+
+    content = "```json\n" + json.dumps(answer, ensure_ascii=False, indent=2) + "\n```"
+    prompt_tokens = sum(len(part.get("text", "")) // 4 for part in parts) + sum(image_tokens(image) for image in images)
+    completion_tokens = len(content) // 4
+
+    return {
+        "id": f"chatcmpl-mock-{time.time_ns()}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": payload.get("model", "mock"),
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+        "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens}
+    }
+
+
+def malformed_content(content, kind):
+    """Break the JSON of a completion, as the models sometimes do."""
+    if kind == "trailing_comma":
+        # Repairable without asking again: a comma before the last closing brace
+        end = content[:content.rfind('}')].rstrip()
+        return end + ',' + content[len(end):]
+    # Cut in the middle, as when max_tokens is reached
+    return content[:len(content) // 2]
+
+
+class MockState:
+    """Files and batches kept in memory by the server, the simulated conditions and the statistics of the requests."""
+
+    def __init__(self, batch_delay, latency=0, latency_jitter=0, rate_limit=None, malformed_rate=0, seed=None):
+        self.lock = threading.Lock()
+        self.batch_delay = batch_delay
+        self.ids = itertools.count(1)
+        self.files = {}
+        self.batches = {}
+
+        # Simulated conditions
+        self.latency = latency                  # seconds before each completion is answered
+        self.latency_jitter = latency_jitter    # random extra seconds, up to this value
+        self.rate_limit = rate_limit            # chat requests per minute before answering 429
+        self.malformed_rate = malformed_rate    # fraction of completions with broken JSON
+        self.random = random.Random(seed)
+        self.recent_requests = deque()
+
+        self.stats = {"requests": 0, "rate_limited": 0, "malformed": 0, "prompt_tokens": 0, "completion_tokens": 0, "latencies": []}
+
+    def rate_limited(self):
+        """Count a chat request. Return the seconds until the next request is allowed, or 0."""
+        with self.lock:
+            self.stats["requests"] += 1
+            if self.rate_limit is None:
+                return 0
+
+            now = time.monotonic()
+            while self.recent_requests and now - self.recent_requests[0] >= 60:
+                self.recent_requests.popleft()
+            if len(self.recent_requests) >= self.rate_limit:
+                self.stats["rate_limited"] += 1
+                return 60 - (now - self.recent_requests[0])
+            self.recent_requests.append(now)
+            return 0
+
+    def rate_limit_headers(self):
+        """Quota left in the simulated window, as reported with each chat completion."""
+        if self.rate_limit is None:
+            return RATE_LIMIT_HEADERS
+
+        with self.lock:
+            now = time.monotonic()
+            while self.recent_requests and now - self.recent_requests[0] >= 60:
+                self.recent_requests.popleft()
+            remaining = max(0, self.rate_limit - len(self.recent_requests))
+            # A request is given back when the oldest one leaves the window
+            reset = 60 - (now - self.recent_requests[0]) if self.recent_requests else 0
+
+        return dict(RATE_LIMIT_HEADERS, **{
+            "x-ratelimit-limit-requests": str(self.rate_limit),
+            "x-ratelimit-remaining-requests": str(remaining),
+            "x-ratelimit-reset-requests": f"{reset * 1000:.0f}ms" if reset < 1 else f"{reset:.3f}s"
+        })
+
+    def simulate(self, body):
+        """Wait for the simulated latency and maybe break the answer. Return the body to send."""
+        with self.lock:
+            delay = self.latency + self.random.uniform(0, self.latency_jitter)
+            malformed = self.random.random() < self.malformed_rate
+            kind = self.random.choice(["trailing_comma", "truncated"])
+        time.sleep(delay)
+
+        if malformed:
+            message = body["choices"][0]["message"]
+            message["content"] = malformed_content(message["content"], kind)
+        return body, malformed
+
+    def record(self, body, malformed, seconds):
+        with self.lock:
+            self.stats["malformed"] += malformed
+            self.stats["prompt_tokens"] += body["usage"]["prompt_tokens"]
+            self.stats["completion_tokens"] += body["usage"]["completion_tokens"]
+            self.stats["latencies"].append(seconds)
+
+    def statistics(self):
+        with self.lock:
+            return dict(self.stats, latencies=list(self.stats["latencies"]))
+
+    def new_id(self, prefix):
+        with self.lock:
+            return f"{prefix}-{next(self.ids)}"
+
+    def run_batch(self, batch):
+        # Answer every request of the input file, as the real batch endpoint does
+        lines = []
+        for line in self.files[batch["input_file_id"]].decode('utf-8').splitlines():
+            if not line.strip():
+                continue
+            request = json.loads(line)
+            lines.append(json.dumps({
+                "id": self.new_id("batch_req"),
+                "custom_id": request["custom_id"],
+                "response": {"status_code": 200, "body": completion_body(request["body"])},
+                "error": None
+            }, ensure_ascii=False))
+
+        output_file_id = self.new_id("file")
+        self.files[output_file_id] = ("\n".join(lines) + "\n").encode('utf-8')
+        batch.update(status="completed", output_file_id=output_file_id,
+                     request_counts={"total": len(lines), "completed": len(lines), "failed": 0})
+
+
+# Quota reported in every chat completion (the requests are replaced by the simulated window with --rate-limit)
+RATE_LIMIT_HEADERS = {
+    "x-ratelimit-limit-requests": "5000",
+    "x-ratelimit-remaining-requests": "4999",
+    "x-ratelimit-reset-requests": "12ms",
+    "x-ratelimit-limit-tokens": "800000",
+    "x-ratelimit-remaining-tokens": "790000",
+    "x-ratelimit-reset-tokens": "750ms"
+}
+
+
+class MockHandler(BaseHTTPRequestHandler):
+
+    def send_json(self, status, body, headers=None):
+        data = json.dumps(body, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_stream(self, body, headers=None):
+        """Send a completion as server-sent events, a few characters per chunk."""
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+
+        def send_event(chunk):
+            self.wfile.write(b"data: " + json.dumps(chunk, ensure_ascii=False).encode('utf-8') + b"\n\n")
+            self.wfile.flush()
+
+        content = body["choices"][0]["message"]["content"]
+        base = {"id": body["id"], "object": "chat.completion.chunk", "created": body["created"], "model": body["model"]}
+        try:
+            for i in range(0, len(content), 16):
+                send_event(dict(base, choices=[{"index": 0, "delta": {"content": content[i:i + 16]}, "finish_reason": None}]))
+            send_event(dict(base, choices=[{"index": 0, "delta": {}, "finish_reason": "stop"}]))
+            send_event(dict(base, choices=[], usage=body["usage"]))
+            self.wfile.write(b"data: [DONE]\n\n")
+        except (BrokenPipeError, ConnectionResetError):
+            # The client stopped reading once its JSON was complete
+            pass
+        self.close_connection = True
+
+    def read_body(self):
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def do_POST(self):
+        state = self.server.state
+
+        if self.path == "/v1/chat/completions":
+            start_time = time.monotonic()
+            payload = json.loads(self.read_body())
+
+            wait_time = state.rate_limited()
+            if wait_time:
+                self.send_json(429, {"error": {
+                    "code": "rate_limit_exceeded",
+                    "type": "requests",
+                    "message": f"Rate limit reached for requests per min (RPM): Limit {state.rate_limit}. Please try again in {wait_time:.3f}s."
+                }}, {"retry-after": str(int(wait_time) + 1)})
+                return
+
+            body, malformed = state.simulate(completion_body(payload))
+            if payload.get("stream"):
+                self.send_stream(body, state.rate_limit_headers())
+            else:
+                self.send_json(200, body, state.rate_limit_headers())
+            state.record(body, malformed, time.monotonic() - start_time)
+
+        elif self.path == "/v1/files":
+            # Parse the multipart upload with the email parser
+            message = BytesParser(policy=HTTP).parsebytes(
+                b"Content-Type: " + self.headers["Content-Type"].encode() + b"\r\n\r\n" + self.read_body())
+            content = next(part.get_payload(decode=True) for part in message.iter_parts() if part.get_filename())
+
+            file_id = state.new_id("file")
+            state.files[file_id] = content
+            self.send_json(200, {"id": file_id, "object": "file", "bytes": len(content), "purpose": "batch"})
+
+        elif self.path == "/v1/batches":
+            request = json.loads(self.read_body())
+            batch = {
+                "id": state.new_id("batch"),
+                "object": "batch",
+                "endpoint": request["endpoint"],
+                "input_file_id": request["input_file_id"],
+                "status": "in_progress",
+                "created_at": time.time(),
+                "request_counts": {"total": 0, "completed": 0, "failed": 0}
+            }
+            state.batches[batch["id"]] = batch
+            self.send_json(200, batch)
+
+        else:
+            self.send_json(404, {"error": {"code": "not_found", "message": f"Unknown path {self.path}"}})
+
+    def do_GET(self):
+        state = self.server.state
+        parts = self.path.strip("/").split("/")
+
+        if parts[:2] == ["v1", "batches"] and len(parts) == 3 and parts[2] in state.batches:
+            batch = state.batches[parts[2]]
+            if batch["status"] == "in_progress" and time.time() - batch["created_at"] >= state.batch_delay:
+                state.run_batch(batch)
+            self.send_json(200, batch)
+
+        elif parts[:2] == ["v1", "files"] and len(parts) == 4 and parts[3] == "content" and parts[2] in state.files:
+            content = state.files[parts[2]]
+            self.send_response(200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        elif self.path == "/mock/stats":
+            # Statistics of the chat requests, used by benchmark.py
+            self.send_json(200, state.statistics())
+
+        else:
+            self.send_json(404, {"error": {"code": "not_found", "message": f"Unknown path {self.path}"}})
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_server(port=8000, batch_delay=0, latency=0, latency_jitter=0, rate_limit=None, malformed_rate=0, seed=None):
+    """Start the server in a background thread and return it (call shutdown() to stop it). Port 0 picks a free port."""
+    server = ThreadingHTTPServer(("127.0.0.1", port), MockHandler)
+    server.state = MockState(batch_delay, latency, latency_jitter, rate_limit, malformed_rate, seed)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local stand-in for the OpenAI API.")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--batch-delay", type=float, default=0, help="seconds before a batch is completed")
+    parser.add_argument("--latency", type=float, default=0, help="seconds before each completion is answered")
+    parser.add_argument("--latency-jitter", type=float, default=0, help="random extra latency, up to this many seconds")
+    parser.add_argument("--rate-limit", type=int, default=None, help="chat requests per minute before answering 429")
+    parser.add_argument("--malformed-rate", type=float, default=0, help="fraction of the completions with broken JSON")
+    parser.add_argument("--seed", type=int, default=None, help="seed of the random latency and broken answers")
+    args = parser.parse_args()
+
+    server = start_server(args.port, args.batch_delay, args.latency, args.latency_jitter, args.rate_limit, args.malformed_rate, args.seed)
+    print(f"Mock OpenAI API listening on http://127.0.0.1:{args.port}/v1 (Ctrl+C to stop)")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.shutdown()
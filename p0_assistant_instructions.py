@@ -47,4 +47,14 @@ Exemplo 2:
 
 }
 ```
-"""
\ No newline at end of file
+"""
+
+packed_instructions = """
+Nesta mensagem serão enviadas várias imagens, cada uma com uma questão diferente.
+Gere como output nenhum texto além de somente um array json contendo exatamente um objeto no formato acima para cada imagem, na mesma ordem em que as imagens foram enviadas.
+"""
+
+repair_instructions = """
+O texto a seguir deveria ser um json de uma questão no formato do JSON Schema abaixo, mas ele não é válido pelos motivos listados.
+Corrija o texto mantendo o seu conteúdo, e gere como output nenhum texto além de somente o json corrigido.
+"""
@@ -0,0 +1,84 @@
+import hashlib
+import json
+import os
+import threading
+
+import p0_configuration as configuration
+
+# Areas selected on each page, kept next to the inputs so the crops can be re-generated without the interface
+ANNOTATIONS_PATH = getattr(configuration, "ANNOTATIONS_PATH", os.path.join("inputs", "annotations.json"))
+
+
+def file_hash(path):
+    """SHA-256 of the file contents."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def scale_areas(areas, from_size, to_size):
+    """Move the points of the areas from a page of from_size (width, height) to the same page rendered at to_size."""
+    scale_x = to_size[0] / from_size[0]
+    scale_y = to_size[1] / from_size[1]
+    return [[[x * scale_x, y * scale_y] for x, y in points] for points in areas]
+
+
+class Annotations:
+    """Sidecar JSON with the areas of each page, the file (and page of the file) it comes from and the hash of that file.
+
+    Each page also remembers the settings of its saved crops, so a replay only re-crops the pages that changed.
+    """
+
+    def __init__(self, path=ANNOTATIONS_PATH, sources=None, dpi=None):
+        self.path = path
+        self.sources = sources or []    # (file, page of the file) of each page, in order
+        self.dpi = dpi                  # resolution of the pages, None for image inputs
+        self.lock = threading.Lock()
+        self.hashes = {}
+        self.pages = {}
+
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as file:
+                self.pages = json.load(file).get("pages", {})
+
+    def source_hash(self, source):
+        with self.lock:
+            if source not in self.hashes:
+                self.hashes[source] = file_hash(source)
+            return self.hashes[source]
+
+    def page(self, page_number):
+        return self.pages.get(str(page_number))
+
+    def page_numbers(self):
+        return sorted(int(page_number) for page_number in self.pages)
+
+    def record(self, page_number, page_size, areas):
+        """Keep the areas selected on a page, in pixels of a page of page_size (width, height)."""
+        source, source_page = self.sources[page_number - 1]
+        entry = {
+            "source": source,
+            "source_page": source_page,
+            "source_hash": self.source_hash(source),
+            "dpi": self.dpi,
+            "size": list(page_size),
+            "areas": [[[float(x), float(y)] for x, y in points] for points in areas]
+        }
+        with self.lock:
+            self.pages[str(page_number)] = entry
+
+    def mark_saved(self, page_number, fingerprint):
+        with self.lock:
+            self.pages[str(page_number)]["saved"] = fingerprint
+
+    def save(self):
+        with self.lock:
+            data = json.dumps({"pages": self.pages}, indent=2)
+
+        # Write a temporary file first, so an interruption never leaves half a file
+        temporary_path = self.path + ".tmp"
+        with open(temporary_path, 'w', encoding='utf-8') as file:
+            file.write(data)
+        os.replace(temporary_path, self.path)
@@ -0,0 +1,76 @@
+import concurrent.futures
+import os
+from collections import deque
+
+from pdf2image import convert_from_path, pdfinfo_from_path
+from PIL import Image, ImageOps
+
+import p0_configuration as configuration
+
+# Resolution of the rasterized PDF pages
+PDF_DPI = getattr(configuration, "PDF_DPI", 200)
+
+# Pages loaded in the background while the current one is annotated
+PREFETCH_PAGES = getattr(configuration, "PREFETCH_PAGES", 2)
+
+# Image files accepted as pages
+INPUT_IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tiff', '.tif')
+
+
+def list_input_images(folder_path):
+    """Image files of the folder, sorted by name (one page each)."""
+    files = [file for file in os.listdir(folder_path) if file.lower().endswith(INPUT_IMAGE_EXTENSIONS)]
+    return [os.path.join(folder_path, file) for file in sorted(files)]
+
+
+def load_image_page(image_path):
+    with Image.open(image_path) as image:
+        # Phone photos are often stored sideways, with the rotation only in the EXIF data
+        image = ImageOps.exif_transpose(image)
+
+        # Convert the image to RGB if it is not already in that mode
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        image.load()
+        return image
+
+
+def render_pdf_page(pdf_path, page_number, dpi):
+    return convert_from_path(pdf_path, dpi=dpi, first_page=page_number, last_page=page_number, thread_count=1)[0]
+
+
+def prefetch_pages(load_page, page_count, prefetch):
+    """Yield (page_number, page_count, image) one page at a time, loading the next pages in background threads."""
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, prefetch)) as executor:
+        pending = deque()
+        next_page = 1
+
+        while next_page <= page_count or pending:
+            # Keep the next pages loading while the current one is in use
+            while next_page <= page_count and len(pending) <= prefetch:
+                pending.append((next_page, executor.submit(load_page, next_page)))
+                next_page += 1
+
+            page_number, future = pending.popleft()
+            yield page_number, page_count, future.result()
+
+
+def pdf_page_count(pdf_path):
+    return pdfinfo_from_path(pdf_path)["Pages"]
+
+
+def load_source_page(source, source_page, dpi=PDF_DPI):
+    """Load a page given by its file (a PDF or an image) and its page number in that file."""
+    if source.lower().endswith('.pdf'):
+        return render_pdf_page(source, source_page, dpi)
+    return load_image_page(source)
+
+
+def iter_pdf_pages(pdf_path, dpi=PDF_DPI, prefetch=PREFETCH_PAGES):
+    page_count = pdf_page_count(pdf_path)
+    return prefetch_pages(lambda page_number: render_pdf_page(pdf_path, page_number, dpi), page_count, prefetch)
+
+
+def iter_image_pages(image_paths, prefetch=PREFETCH_PAGES):
+    # Pages are read straight from the image files, at their own resolution
+    return prefetch_pages(lambda page_number: load_image_page(image_paths[page_number - 1]), len(image_paths), prefetch)
@@ -1,10 +1,29 @@
 import matplotlib.pyplot as plt
-from pdf2image import convert_from_path
 import cv2
-from PIL import Image
 import numpy as np
 import os
-import img2pdf
+import argparse
+import concurrent.futures
+import threading
+from collections import deque
+
+from p1_annotations import ANNOTATIONS_PATH, Annotations, scale_areas
+from p1_page_source import PDF_DPI, PREFETCH_PAGES, iter_image_pages, iter_pdf_pages, list_input_images, load_source_page, pdf_page_count
+from p1_region_detection import detect_question_regions_timed
+
+import p0_configuration as configuration
+
+# Format of the saved question areas ("png" is lossless, better for the OCR but larger)
+AREA_FORMAT = getattr(configuration, "AREA_FORMAT", "jpg")  # "jpg", "png" or "webp"
+AREA_QUALITY = getattr(configuration, "AREA_QUALITY", 95)    # JPEG/WebP quality (above 100 for lossless WebP)
+AREA_EXTENSIONS = ('.jpg', '.png', '.webp')
+
+# Threads that warp and save the areas
+WARP_WORKERS = getattr(configuration, "WARP_WORKERS", 4)
+
+# What p2_main.py saved for each area, removed with the area when it no longer exists
+SOLVED_OUTPUTS = (os.path.join('output_1_jsons', '{}.json'), os.path.join('output_1_jsons', '{}.json.partial'),
+                  os.path.join('api_responses', '{}_resp.json'))
 
 def check_folder_contents_and_format(folder_path):
     """Function to check contents of the folder and identify the image format"""
@@ -50,13 +69,29 @@ def create_output_folder(output_folder):
     if not os.path.exists(output_folder):
         os.makedirs(output_folder)
 
-def select_multiple_groups_of_points(image):
+def select_multiple_groups_of_points(image, proposed_groups=None):
     groups_of_points = []
+    group_artists = []
     current_points = []
+    current_artists = []
 
     fig, ax = plt.subplots()
     ax.imshow(image)
-    plt.title("Select 4 points for each area on this page. Press Enter when done.")
+    if proposed_groups:
+        plt.title("Check the proposed areas: press U to undo the last one, X to remove all, click 4 points to add one. Press Enter when done.", fontsize=8)
+    else:
+        plt.title("Select 4 points for each area on this page. Press Enter when done.")
+
+    def add_group(points, color, artists):
+        # Draw polygon of a complete area
+        poly = plt.Polygon(points, color=color, alpha=0.4, fill=True)
+        ax.add_patch(poly)
+        groups_of_points.append([list(point) for point in points])
+        group_artists.append(artists + [poly])
+
+    # Show the areas found by the automatic detection
+    for points in proposed_groups or []:
+        add_group(points, 'blue', [])
 
     def onclick(event):
         # Add point on click and immediately mark it
@@ -64,29 +99,49 @@ def select_multiple_groups_of_points(image):
             current_point = [event.xdata, event.ydata]
             current_points.append(current_point)
             # Immediately mark the selected point
-            ax.plot(current_point[0], current_point[1], 'r+', markersize=12)
+            current_artists.extend(ax.plot(current_point[0], current_point[1], 'r+', markersize=12))
 
             if len(current_points) == 4:
                 # Draw polygon after the fourth point is selected
-                poly = plt.Polygon(current_points, color='red', alpha=0.4, fill=True)
-                ax.add_patch(poly)
-                groups_of_points.append(current_points.copy())
+                add_group(current_points, 'red', current_artists.copy())
                 current_points.clear()
+                current_artists.clear()
             plt.draw()
 
     def onkeypress(event):
         # Finalize selection with Enter
         if event.key == 'enter':
             plt.close(fig)
+        # Undo the last area, or remove all of them
+        elif event.key in ('u', 'x'):
+            while groups_of_points:
+                groups_of_points.pop()
+                for artist in group_artists.pop():
+                    artist.remove()
+                if event.key == 'u':
+                    break
+            plt.draw()
 
     fig.canvas.mpl_connect('button_press_event', onclick)
     fig.canvas.mpl_connect('key_press_event', onkeypress)
     plt.show()
     return groups_of_points
 
-def perspective_transform_and_save(original_image, points, output_filename):
+def is_axis_aligned(points, tolerance=1.0):
+    """True if the quadrilateral (clockwise from the top-left corner) is a rectangle with horizontal and vertical sides."""
+    return (abs(points[0][1] - points[1][1]) <= tolerance and abs(points[3][1] - points[2][1]) <= tolerance
+            and abs(points[0][0] - points[3][0]) <= tolerance and abs(points[1][0] - points[2][0]) <= tolerance)
+
+def warp_area(page_array, points):
     points = np.array(points, dtype='float32')
 
+    # Plain rectangles only need a slice of the page
+    if is_axis_aligned(points):
+        height, width = page_array.shape[:2]
+        x0, y0 = np.maximum(np.floor(points.min(axis=0)).astype(int), 0)
+        x1, y1 = np.ceil(points.max(axis=0)).astype(int)
+        return page_array[y0:min(y1, height), x0:min(x1, width)].copy()
+
     max_width = max(int(np.linalg.norm(points[0] - points[1])), int(np.linalg.norm(points[2] - points[3])))
     max_height = max(int(np.linalg.norm(points[0] - points[3])), int(np.linalg.norm(points[1] - points[2])))
 
@@ -97,25 +152,200 @@ def perspective_transform_and_save(original_image, points, output_filename):
         [0, max_height - 1]], dtype='float32')
 
     matrix = cv2.getPerspectiveTransform(points, dst)
-    result = cv2.warpPerspective(np.array(original_image), matrix, (max_width, max_height))
+    return cv2.warpPerspective(page_array, matrix, (max_width, max_height))
 
-    Image.fromarray(result).save(output_filename)
+def encode_area(area, extension):
+    # OpenCV expects BGR images
+    if area.ndim == 3:
+        area = cv2.cvtColor(area, cv2.COLOR_RGB2BGR)
 
-def process_pdf(pdf_path, output_folder):
-    create_output_folder(output_folder)
+    if extension == ".png":
+        success, buffer = cv2.imencode(".png", area, [cv2.IMWRITE_PNG_COMPRESSION, 3])
+    elif extension == ".webp":
+        # Quality above 100 makes WebP lossless
+        success, buffer = cv2.imencode(".webp", area, [cv2.IMWRITE_WEBP_QUALITY, AREA_QUALITY])
+    else:
+        success, buffer = cv2.imencode(".jpg", area, [cv2.IMWRITE_JPEG_QUALITY, AREA_QUALITY])
+
+    if not success:
+        raise ValueError(f"Could not encode area as {extension}")
+    return buffer.tobytes()
+
+def perspective_transform_and_save(original_image, points, output_filename):
+    result = warp_area(np.asarray(original_image), points)
+
+    with open(output_filename, 'wb') as file:
+        file.write(encode_area(result, os.path.splitext(output_filename)[1].lower()))
 
-    # Convert all pages of the PDF to images
+def process_pdf(pdf_path, output_folder, dpi=PDF_DPI, prefetch=PREFETCH_PAGES, detect=False, review=True, workers=None, annotations=None, on_area_saved=None):
+    # Convert the pages of the PDF to images, one at a time
     print("Processing PDF...")
-    images = convert_from_path(pdf_path)
-    
-    for i, page_image in enumerate(images):
-        print(f"Processing page {i+1}/{len(images)}...")
-        groups_of_points = select_multiple_groups_of_points(page_image)
+    process_pages(iter_pdf_pages(pdf_path, dpi, prefetch), output_folder, detect, review, workers, annotations, on_area_saved)
+
+def detect_ahead(pages, executor, lookahead):
+    """Yield (page_number, page_count, image, proposed_groups), detecting the areas of the next pages in the process pool."""
+    pending = deque()
+
+    def finish(page_number, page_count, page_image, future):
+        _, proposed_groups, seconds = future.result()
+        print(f"Detected {len(proposed_groups)} areas on page {page_number} in {seconds:.2f}s")
+        return page_number, page_count, page_image, proposed_groups
+
+    for page_number, page_count, page_image in pages:
+        future = executor.submit(detect_question_regions_timed, page_number, np.asarray(page_image))
+        pending.append((page_number, page_count, page_image, future))
+        if len(pending) > lookahead:
+            yield finish(*pending.popleft())
+
+    while pending:
+        yield finish(*pending.popleft())
+
+def process_pages(pages, output_folder, detect=False, review=True, workers=None, annotations=None, on_area_saved=None):
+    """Select the question areas of each (page_number, page_count, image) and save them.
+
+    With detect, the areas are proposed by the automatic detection and shown for review (or saved as they are without review).
+    The selected areas are kept in the annotations, if given, to be replayed later. on_area_saved is called with the file name
+    of each saved area, as soon as it is written.
+    """
+    create_output_folder(output_folder)
+
+    def select_and_save(page_number, page_image, groups_of_points, warp_executor):
+        # A page skipped without a selection keeps its crops and annotation from an earlier run
+        if not groups_of_points:
+            print(f"No areas selected on page {page_number}, keeping its earlier crops.")
+            return
+
+        save_areas(page_image, page_number, groups_of_points, output_folder, warp_executor, on_area_saved)
+        if annotations is not None:
+            annotations.record(page_number, page_image.size, groups_of_points)
+            annotations.mark_saved(page_number, saved_fingerprint(annotations.page(page_number), annotations.dpi))
+            annotations.save()
+
+    # The areas are warped and saved in background threads, so the next page can be shown right away
+    with concurrent.futures.ThreadPoolExecutor(max_workers=WARP_WORKERS) as warp_executor:
+        if not detect:
+            for page_number, page_count, page_image in pages:
+                print(f"Processing page {page_number}/{page_count}...")
+                select_and_save(page_number, page_image, select_multiple_groups_of_points(page_image), warp_executor)
+            return
+
+        workers = workers or os.cpu_count()
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            for page_number, page_count, page_image, proposed_groups in detect_ahead(pages, executor, workers):
+                print(f"Processing page {page_number}/{page_count}...")
+                if review:
+                    groups_of_points = select_multiple_groups_of_points(page_image, proposed_groups)
+                else:
+                    groups_of_points = proposed_groups
+                select_and_save(page_number, page_image, groups_of_points, warp_executor)
+
+def saved_fingerprint(entry, dpi):
+    """Everything that decides the saved crops of an annotated page."""
+    return {
+        "areas": entry["areas"],
+        # The resolution only matters for PDF pages
+        "dpi": dpi if entry["dpi"] is not None else None,
+        "format": AREA_FORMAT,
+        "quality": AREA_QUALITY
+    }
+
+def replay_page(annotations, page_number, output_folder, dpi, on_area_saved=None):
+    entry = annotations.page(page_number)
+    page_image = load_source_page(entry["source"], entry["source_page"], dpi)
 
-        for j, group in enumerate(groups_of_points):
-            output_filename = os.path.join(output_folder, f"output_page_{(i+1):03d}_area_{j}.jpg")
-            perspective_transform_and_save(page_image, group, output_filename)
-            print(f"Saved {output_filename}")
+    # The points were selected on the page at its resolution at the time
+    areas = scale_areas(entry["areas"], entry["size"], page_image.size)
+    save_areas(page_image, page_number, areas, output_folder, on_saved=on_area_saved)
+    annotations.mark_saved(page_number, saved_fingerprint(entry, dpi))
+
+def replay_annotations(annotations, output_folder, dpi=PDF_DPI, workers=None, on_area_saved=None):
+    """Re-crop the annotated pages whose areas, resolution or format changed since they were saved, without the interface."""
+    create_output_folder(output_folder)
+
+    changed_pages = []
+    for page_number in annotations.page_numbers():
+        entry = annotations.page(page_number)
+        if not os.path.exists(entry["source"]) or annotations.source_hash(entry["source"]) != entry["source_hash"]:
+            print(f"Skipping page {page_number}: {entry['source']} changed since it was annotated")
+            continue
+
+        saved = entry.get("saved") == saved_fingerprint(entry, dpi)
+        if saved and all(os.path.exists(area_filename(output_folder, page_number, j)) for j in range(len(entry["areas"]))):
+            continue
+        changed_pages.append(page_number)
+
+    print(f"Re-cropping {len(changed_pages)} of {len(annotations.page_numbers())} annotated pages...")
+
+    # Rendering and cropping release the GIL, so the pages are done in threads
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+        futures = {executor.submit(replay_page, annotations, page_number, output_folder, dpi, on_area_saved): page_number for page_number in changed_pages}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                print(f"Error on page {futures[future]}: {e}")
+
+    annotations.save()
+
+def area_filename(output_folder, page_number, area_index):
+    return os.path.join(output_folder, f"output_page_{page_number:03d}_area_{area_index}.{AREA_FORMAT}")
+
+print_lock = threading.Lock()
+
+def report_saved(future, output_filename, on_saved=None):
+    # Keep the messages of the saving threads on separate lines
+    with print_lock:
+        if future.exception() is not None:
+            print(f"Error saving {output_filename}: {future.exception()}")
+            return
+        print(f"Saved {output_filename}")
+
+    if on_saved is not None:
+        on_saved(output_filename)
+
+def save_areas(page_image, page_number, groups_of_points, output_folder, executor=None, on_saved=None):
+    """Save every area of a page, in the executor if one is given, calling on_saved with each file written. Return the futures of the saved areas."""
+
+    # Decode the page once for all of its areas
+    page_array = np.asarray(page_image)
+
+    futures = []
+    for j, group in enumerate(groups_of_points):
+        output_filename = area_filename(output_folder, page_number, j)
+
+        # An area saved before in another format would be solved twice
+        for extension in AREA_EXTENSIONS:
+            other_filename = os.path.splitext(output_filename)[0] + extension
+            if other_filename != output_filename and os.path.exists(other_filename):
+                os.remove(other_filename)
+
+        if executor is None:
+            perspective_transform_and_save(page_array, group, output_filename)
+            with print_lock:
+                print(f"Saved {output_filename}")
+            if on_saved is not None:
+                on_saved(output_filename)
+        else:
+            future = executor.submit(perspective_transform_and_save, page_array, group, output_filename)
+            future.add_done_callback(lambda future, output_filename=output_filename: report_saved(future, output_filename, on_saved))
+            futures.append(future)
+
+    # Areas left from an earlier selection with more areas on this page (none to remove when the page was skipped)
+    j = len(groups_of_points)
+    while groups_of_points and any(os.path.exists(os.path.splitext(area_filename(output_folder, page_number, j))[0] + extension) for extension in AREA_EXTENSIONS):
+        stale_base = os.path.splitext(area_filename(output_folder, page_number, j))[0]
+        for extension in AREA_EXTENSIONS:
+            if os.path.exists(stale_base + extension):
+                os.remove(stale_base + extension)
+
+        # Its question would otherwise be assembled without its image
+        for solved_output in SOLVED_OUTPUTS:
+            solved_filename = solved_output.format(os.path.basename(stale_base))
+            if os.path.exists(solved_filename):
+                os.remove(solved_filename)
+        j += 1
+
+    return futures
 
 def get_sole_pdf_name(folder_path):
     # Define the folder path
@@ -137,62 +367,48 @@ def get_sole_pdf_name(folder_path):
     else:
         return "The folder 'inputs' does not exist."
 
-def images_to_pdf(directory, output_pdf_path):
-    print("Processing input images...")
+def prepare_inputs(folder_path='inputs', output_folder='output_0_areas', dpi=PDF_DPI, prefetch=PREFETCH_PAGES, detect=False, review=True,
+                   workers=None, replay=False, on_area_saved=None):
+    """Select (or replay) the question areas of the files in folder_path and save them in output_folder."""
+    print("Preparing inputs...")
 
-    # List to hold images that are converted to RGB mode
-    img_list = []
-    
-    # Iterate over each image in the directory
-    for img_name in sorted(os.listdir(directory)):
-        if img_name.endswith((".jpg", ".jpeg", ".png", ".bmp", ".tif", ".tiff")):
-            img_path = os.path.join(directory, img_name)
-            # Open the image using Pillow
-            img = Image.open(img_path)
-            # Convert the image to RGB if it is not already in that mode
-            if img.mode != 'RGB':
-                img = img.convert('RGB')
-            img_list.append(img)
-
-    # Convert the list of images to a single PDF
-    if img_list:
-        img_list[0].save(output_pdf_path, save_all=True, append_images=img_list[1:], resolution=100.0)
-        print(f"PDF created successfully: {output_pdf_path}")
-    else:
-        print("No images found in the directory.")
+    (file_type, file_count) = check_folder_contents_and_format(folder_path)
 
-if __name__ == "__main__":
+    # Define the pages based on file_type
+    if replay:
+        replay_annotations(Annotations(ANNOTATIONS_PATH), output_folder, dpi, workers, on_area_saved)
+    elif file_type == 'pdf':
+        input_pdf_path = os.path.join(folder_path, get_sole_pdf_name(folder_path))
+        sources = [(input_pdf_path, page_number) for page_number in range(1, pdf_page_count(input_pdf_path) + 1)]
+        annotations = Annotations(ANNOTATIONS_PATH, sources, dpi)
+        process_pdf(input_pdf_path, output_folder, dpi, prefetch, detect, review, workers, annotations, on_area_saved)
+    else:
+        print("Processing input images...")
+        image_paths = list_input_images(folder_path)
+        annotations = Annotations(ANNOTATIONS_PATH, [(image_path, 1) for image_path in image_paths])
+        process_pages(iter_image_pages(image_paths, prefetch), output_folder, detect, review, workers, annotations, on_area_saved)
 
-    # Define the folder path
-    folder_path = 'inputs'
 
-    try:
-        print("Preparing inputs...")
-        
-        (file_type, file_count) = check_folder_contents_and_format(folder_path)
+def add_arguments(parser):
+    """Options of the area selection, shared with pipeline.py."""
+    parser.add_argument("--dpi", type=int, default=PDF_DPI, help="resolution of the rasterized PDF pages")
+    parser.add_argument("--prefetch", type=int, default=PREFETCH_PAGES, help="pages loaded in the background while the current one is annotated")
+    parser.add_argument("--auto", action="store_true", help="propose the question areas automatically, to be accepted or adjusted")
+    parser.add_argument("--headless", action="store_true", help="save the automatically detected areas without review (implies --auto)")
+    parser.add_argument("--workers", type=int, default=None, help="processes used by the automatic detection or the replay (default: all cores)")
+    parser.add_argument("--replay", action="store_true", help=f"re-crop the pages saved in {ANNOTATIONS_PATH} without the interface, only where the areas, --dpi or format changed")
 
-        # Define the input_pdf_path based on file_type
-        if file_type == 'pdf':
-            input_pdf_path = os.path.join(folder_path, get_sole_pdf_name(folder_path))
-        else:
-            pdf_path = os.path.join(folder_path, "temporary.pdf")
-            images_to_pdf(folder_path, pdf_path)
-            input_pdf_path = pdf_path
 
-        # Create a folder with all the cropped image areas from the PDF
-        output_folder = 'output_0_areas'
-        if not os.path.exists(output_folder):
-            os.makedirs(output_folder)
+if __name__ == "__main__":
 
-        process_pdf(input_pdf_path, output_folder)
+    parser = argparse.ArgumentParser(description="Select the question areas of the files in inputs.")
+    add_arguments(parser)
+    args = parser.parse_args()
 
-        # Remove temporary file
-        temp_pdf_path = os.path.join(folder_path, "temporary.pdf")
-        if os.path.exists(temp_pdf_path):
-            os.remove(temp_pdf_path)
-            print(f"PDF removed successfully: {temp_pdf_path}")
+    try:
+        # Create a folder with all the cropped image areas from the pages
+        prepare_inputs('inputs', 'output_0_areas', args.dpi, args.prefetch, args.auto or args.headless, not args.headless,
+                       args.workers, args.replay)
 
     except Exception as e:
         print(f'Error: {e}')
-
-
@@ -0,0 +1,136 @@
+import time
+
+import cv2
+import numpy as np
+
+import p0_configuration as configuration
+
+# Parameters of the automatic detection (can be overwritten in p0_configuration.py)
+DETECTION_GAP_FACTOR = getattr(configuration, "DETECTION_GAP_FACTOR", 2.0)       # gap between blocks, in median line gaps
+DETECTION_MIN_AREA_HEIGHT = getattr(configuration, "DETECTION_MIN_AREA_HEIGHT", 40)  # pixels
+DETECTION_PADDING = getattr(configuration, "DETECTION_PADDING", 12)                  # pixels around each area
+DETECTION_MARGIN_TOLERANCE = getattr(configuration, "DETECTION_MARGIN_TOLERANCE", 0.02)  # fraction of the page width
+
+
+def binarize(page):
+    """Ink pixels as 255, background as 0."""
+    gray = cv2.cvtColor(page, cv2.COLOR_RGB2GRAY) if page.ndim == 3 else page
+    _, ink = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY_INV | cv2.THRESH_OTSU)
+
+    # Remove specks of noise (scanner dust, JPEG artifacts)
+    return cv2.morphologyEx(ink, cv2.MORPH_OPEN, np.ones((2, 2), np.uint8))
+
+
+def runs(mask):
+    """(start, end) of each run of True values in a 1D mask."""
+    padded = np.concatenate(([False], mask, [False]))
+    changes = np.flatnonzero(padded[1:] != padded[:-1])
+    return list(zip(changes[::2], changes[1::2]))
+
+
+def find_columns(ink):
+    """Split two-column layouts at a wide blank gutter near the middle of the page."""
+    height, width = ink.shape
+    column_has_ink = (ink > 0).sum(axis=0) > height * 0.002
+
+    for start, end in runs(~column_has_ink):
+        if end - start > width * 0.03 and width * 0.3 < (start + end) / 2 < width * 0.7:
+            return [(0, start), (end, width)]
+    return [(0, width)]
+
+
+def find_lines(ink):
+    """Text lines as (top, bottom, words), where words are the (left, right) ranges of the line."""
+    row_has_ink = (ink > 0).sum(axis=1) > 0
+    lines = []
+    for top, bottom in runs(row_has_ink):
+        line_height = bottom - top
+
+        # Words: ink columns separated by gaps wider than a letter spacing
+        column_has_ink = (ink[top:bottom] > 0).any(axis=0)
+        merged = cv2.dilate(column_has_ink.astype(np.uint8).reshape(1, -1), np.ones((1, max(3, line_height // 3)), np.uint8)).ravel() > 0
+        words = runs(merged)
+        if words:
+            lines.append((top, bottom, words))
+    return lines
+
+
+def looks_numbered(words, line_height, left_margin, tolerance):
+    """True if the line starts at the margin with a question number, such as "1." or "Questão 2"."""
+    if not words or words[0][0] > left_margin + tolerance:
+        return False
+
+    first_width = words[0][1] - words[0][0]
+    if first_width <= 2 * line_height:
+        return True
+    return len(words) > 1 and first_width <= 6 * line_height and words[1][1] - words[1][0] <= 1.5 * line_height
+
+
+def find_blocks(lines, gap_factor):
+    """Group the lines into blocks separated by gaps larger than usual."""
+    if not lines:
+        return []
+
+    gaps = [lines[i + 1][0] - lines[i][1] for i in range(len(lines) - 1)]
+    median_gap = np.median(gaps) if gaps else 0
+    threshold = max(median_gap * gap_factor, 1)
+
+    blocks = [[lines[0]]]
+    for gap, line in zip(gaps, lines[1:]):
+        if gap > threshold:
+            blocks.append([line])
+        else:
+            blocks[-1].append(line)
+    return blocks
+
+
+def detect_question_regions(page):
+    """Propose one quadrilateral per question of the page, clockwise from the top-left corner."""
+    page = np.asarray(page)
+    height, width = page.shape[:2]
+    ink = binarize(page)
+    tolerance = width * DETECTION_MARGIN_TOLERANCE
+
+    regions = []
+    for column_left, column_right in find_columns(ink):
+        lines = find_lines(ink[:, column_left:column_right])
+        blocks = find_blocks(lines, DETECTION_GAP_FACTOR)
+        if not blocks:
+            continue
+
+        # Blocks that do not start with a number belong to the question above them. So do lists where
+        # every line starts like a number, which are the alternatives "a)", "b)"... of that question.
+        left_margin = min(words[0][0] for _, _, words in lines)
+        questions = []
+        for block in blocks:
+            numbered = [looks_numbered(words, bottom - top, left_margin, tolerance) for top, bottom, words in block]
+            is_list = len(block) > 1 and all(numbered)
+            if not questions or (numbered[0] and not is_list):
+                questions.append(list(block))
+            else:
+                questions[-1].extend(block)
+
+        # No numbering found at all: keep the blocks separated by whitespace
+        if len(questions) == 1 and len(blocks) > 1:
+            questions = blocks
+
+        for question in questions:
+            top = question[0][0]
+            bottom = question[-1][1]
+            if bottom - top < DETECTION_MIN_AREA_HEIGHT:
+                continue
+            left = column_left + min(words[0][0] for _, _, words in question)
+            right = column_left + max(words[-1][1] for _, _, words in question)
+
+            x0, y0 = max(0, left - DETECTION_PADDING), max(0, top - DETECTION_PADDING)
+            x1, y1 = min(width - 1, right + DETECTION_PADDING), min(height - 1, bottom + DETECTION_PADDING)
+            regions.append([[x0, y0], [x1, y0], [x1, y1], [x0, y1]])
+
+    return [[[float(x), float(y)] for x, y in region] for region in regions]
+
+
+def detect_question_regions_timed(page_number, page):
+    """Run the detection of one page, returning (page_number, regions, seconds). Used by the process pool."""
+    start_time = time.perf_counter()
+    regions = detect_question_regions(page)
+    return page_number, regions, time.perf_counter() - start_time
@@ -0,0 +1,126 @@
+import asyncio
+import json
+import time
+
+import aiohttp
+
+import p0_configuration as configuration
+from p2_journal import DONE, FAILED, IN_FLIGHT, MAX_RETRIES, backoff_delay
+from p2_main import (API_URL, REQUEST_TIMEOUT, build_payload, cached_response, encode_image, estimate_request_tokens, handle_response, image_name,
+                     pause_on_rate_limit, release_unused_tokens, remove_partial_enunciado, report_exception, request_headers,
+                     solve_from_duplicate)
+from p2_metrics import get_shared_metrics
+from p2_routing import escalation_reason, tier_limiter, tiers_for
+
+# Maximum number of requests being sent or waited on at the same time
+MAX_IN_FLIGHT = getattr(configuration, "MAX_IN_FLIGHT", 16)
+
+
+async def gpt_request_async(session, image_path, slot_wait=0, journal=None):
+    """Same as gpt_request, using the pooled aiohttp session. slot_wait is the time spent waiting for a free slot, counted in the queue time."""
+
+    # Skip the API call for images that were already solved
+    data = await asyncio.to_thread(cached_response, image_path)
+    if data is not None:
+        return data
+
+    tiers = await asyncio.to_thread(tiers_for, image_path, journal.tier(image_path) if journal is not None else None)
+    for i, tier in enumerate(tiers):
+        data = await model_request_async(session, image_path, tier, slot_wait)
+        slot_wait = 0
+
+        reason = escalation_reason(data) if i < len(tiers) - 1 else None
+        if reason is None:
+            return data
+        print(f"Escalating {image_path} from {tier['model']} to {tiers[i + 1]['model']}: {reason}")
+        if journal is not None:
+            journal.record_tier(image_path, tiers[i + 1]["model"])
+
+
+async def model_request_async(session, image_path, tier, slot_wait=0):
+    """Same as model_request, using the pooled aiohttp session."""
+    print(f"Making request for OpenAI API...")
+
+    # Read and encode the image without blocking the event loop
+    start_time = time.perf_counter()
+    base64_image, mime_type, image_tokens = await asyncio.to_thread(encode_image, image_path)
+    payload = build_payload(base64_image, mime_type, tier["model"])
+    body = json.dumps(payload).encode('utf-8')
+    encode_seconds = time.perf_counter() - start_time
+
+    # Deal with OpenAI API Rate Limits: wait for room in the shared budget of the model
+    limiter = tier_limiter(tier)
+    estimated_tokens = estimate_request_tokens(payload, image_tokens)
+    start_time = time.perf_counter()
+    await limiter.acquire_async(estimated_tokens)
+    queue_seconds = slot_wait + time.perf_counter() - start_time
+
+    # Make API call on one of the keep-alive connections
+    start_time = time.perf_counter()
+    async with session.post(API_URL, headers=request_headers(), data=body) as response:
+        data = await response.json(content_type=None)
+        latency_seconds = time.perf_counter() - start_time
+
+        # Adjust the budget with what the API reports
+        limiter.update_from_headers(response.headers)
+        pause_on_rate_limit(response.status, response.headers, data, limiter)
+
+    get_shared_metrics().record_request([image_name(image_path)], "solve", data, response.status,
+                                        encode_seconds, queue_seconds, latency_seconds, len(body), tier["model"])
+
+    release_unused_tokens(limiter, estimated_tokens, data)
+
+    return data
+
+
+async def solve_image(session, semaphore, image_path, journal):
+    """Make the API call for one image, retrying with exponential backoff until it works or MAX_RETRIES is reached."""
+    if await asyncio.to_thread(solve_from_duplicate, image_path, journal):
+        return
+
+    while True:
+        journal.record(image_path, IN_FLIGHT)
+        try:
+            start_time = time.perf_counter()
+            async with semaphore:
+                data = await gpt_request_async(session, image_path, time.perf_counter() - start_time, journal)
+
+            # Write the JSON files in a thread while other requests go on
+            await asyncio.to_thread(handle_response, image_path, data)
+        except Exception as e:
+            report_exception(image_path, e)
+            remove_partial_enunciado(image_name(image_path))
+            journal.record(image_path, FAILED, error=e)
+
+            attempts = journal.attempts(image_path)
+            if attempts >= MAX_RETRIES:
+                raise
+            delay = backoff_delay(attempts)
+            print(f"Retrying {image_path} in {delay:.1f}s (attempt {attempts + 1} of {MAX_RETRIES})")
+            await asyncio.sleep(delay)
+        else:
+            journal.record(image_path, DONE)
+            return
+
+
+async def run_async_batch(files, journal, max_in_flight):
+    failed_files = []
+
+    # One session for the whole batch, reusing its TLS connections
+    connector = aiohttp.TCPConnector(limit=max_in_flight, keepalive_timeout=60)
+    timeout = aiohttp.ClientTimeout(total=REQUEST_TIMEOUT)
+
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        semaphore = asyncio.Semaphore(max_in_flight)
+        results = await asyncio.gather(*(solve_image(session, semaphore, image_file, journal) for image_file in files), return_exceptions=True)
+
+    for image_file, result in zip(files, results):
+        if isinstance(result, Exception):
+            failed_files.append(image_file)
+
+    return failed_files
+
+
+def run_async(files, journal, max_in_flight=None):
+    """Make the API calls in a single event loop. Return the files that failed."""
+    return asyncio.run(run_async_batch(files, journal, max_in_flight or MAX_IN_FLIGHT))
@@ -0,0 +1,174 @@
+import json
+import os
+import time
+
+import requests
+
+import p0_configuration as configuration
+from p0_configuration import API_KEY
+from p2_journal import DONE, FAILED, IN_FLIGHT
+from p2_main import API_BASE_URL, build_payload, encode_image, handle_response, image_name, report_exception, solve_from_cache
+from p2_metrics import get_shared_metrics
+
+# Seconds between two checks of the batch status
+BATCH_POLL_INTERVAL = getattr(configuration, "BATCH_POLL_INTERVAL", 60)
+
+# Time the API has to finish the batch
+BATCH_COMPLETION_WINDOW = getattr(configuration, "BATCH_COMPLETION_WINDOW", "24h")
+
+# Files of the batch in progress
+BATCH_REQUESTS_PATH = os.path.join("api_responses", "requests.jsonl")
+BATCH_STATE_PATH = os.path.join("api_responses", "batch.json")
+
+# Final statuses of a batch
+FINISHED_STATUSES = ("completed", "failed", "expired", "cancelled")
+
+
+class BatchError(Exception):
+    """The batch could not be submitted or did not complete."""
+
+
+def authorization_headers():
+    return {"Authorization": f"Bearer {API_KEY}"}
+
+
+def check_response(response):
+    if response.status_code != 200:
+        raise BatchError(f"{response.status_code}: {response.text}")
+    return response
+
+
+def write_batch_file(files, batch_path, journal):
+    """Write one chat completion request per line, using the image path as custom_id. Return the files written."""
+    written_files = []
+    with open(batch_path, 'w', encoding='utf-8') as file:
+        for image_file in files:
+            try:
+                base64_image, mime_type, _ = encode_image(image_file)
+            except Exception as e:
+                report_exception(image_file, e)
+                journal.record(image_file, FAILED, error=e)
+                continue
+            request = {
+                "custom_id": image_file,
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": build_payload(base64_image, mime_type)
+            }
+            file.write(json.dumps(request) + "\n")
+            written_files.append(image_file)
+
+    return written_files
+
+
+def submit_batch(batch_path):
+    """Upload the batch file and start the batch. Return the batch id."""
+    with open(batch_path, 'rb') as file:
+        response = requests.post(f"{API_BASE_URL}/files", headers=authorization_headers(),
+                                 data={"purpose": "batch"}, files={"file": (os.path.basename(batch_path), file)})
+    input_file_id = check_response(response).json()["id"]
+
+    response = requests.post(f"{API_BASE_URL}/batches", headers=authorization_headers(), json={
+        "input_file_id": input_file_id,
+        "endpoint": "/v1/chat/completions",
+        "completion_window": BATCH_COMPLETION_WINDOW
+    })
+    return check_response(response).json()["id"]
+
+
+def wait_for_batch(batch_id):
+    """Poll the batch until it reaches a final status. Return the batch object."""
+    while True:
+        response = requests.get(f"{API_BASE_URL}/batches/{batch_id}", headers=authorization_headers())
+        batch = check_response(response).json()
+
+        counts = batch.get("request_counts") or {}
+        print(f"Batch {batch_id}: {batch['status']} ({counts.get('completed', 0)}/{counts.get('total', '?')} completed, {counts.get('failed', 0)} failed)")
+
+        if batch["status"] in FINISHED_STATUSES:
+            return batch
+        time.sleep(BATCH_POLL_INTERVAL)
+
+
+def download_file(file_id):
+    response = requests.get(f"{API_BASE_URL}/files/{file_id}/content", headers=authorization_headers())
+    return check_response(response).text
+
+
+def split_results(batch, journal):
+    """Save each result line into api_responses and output_1_jsons. Return the files that failed."""
+    failed_files = []
+
+    lines = []
+    for file_id in (batch.get("output_file_id"), batch.get("error_file_id")):
+        if file_id:
+            lines += download_file(file_id).splitlines()
+
+    for line in lines:
+        if not line.strip():
+            continue
+        result = json.loads(line)
+        image_file = result["custom_id"]
+
+        # Batch requests have no latency of their own, only their tokens are counted
+        response = result.get("response") or {}
+        get_shared_metrics().record_request([image_name(image_file)], "batch", response.get("body"), response.get("status_code"))
+
+        try:
+            if result.get("error"):
+                raise BatchError(f"{result['error'].get('code')}: {result['error'].get('message')}")
+            handle_response(image_file, result["response"]["body"])
+        except Exception as e:
+            report_exception(image_file, e)
+            journal.record(image_file, FAILED, error=e)
+            failed_files.append(image_file)
+        else:
+            journal.record(image_file, DONE)
+
+    return failed_files
+
+
+def run_batch(files, journal):
+    """Solve the images with one batch job. Return the files that failed."""
+
+    # Images already solved are answered from the cache, without entering the batch
+    batch_files = solve_from_cache(files, journal)
+
+    failed_files = []
+
+    # Resume the batch of an interrupted run instead of submitting it again
+    if os.path.exists(BATCH_STATE_PATH):
+        with open(BATCH_STATE_PATH, 'r') as file:
+            state = json.load(file)
+        print(f"Resuming batch {state['batch_id']}...")
+
+        new_files = set(batch_files) - set(state["files"])
+        if new_files:
+            print(f"{len(new_files)} images are not in this batch and will be sent in the next run.")
+    elif batch_files:
+        print(f"Writing {len(batch_files)} requests to {BATCH_REQUESTS_PATH}...")
+        written_files = write_batch_file(batch_files, BATCH_REQUESTS_PATH, journal)
+        failed_files = [image_file for image_file in batch_files if image_file not in written_files]
+        if not written_files:
+            return failed_files
+
+        state = {"batch_id": submit_batch(BATCH_REQUESTS_PATH), "files": written_files}
+        with open(BATCH_STATE_PATH, 'w') as file:
+            json.dump(state, file, indent=4)
+        for image_file in written_files:
+            journal.record(image_file, IN_FLIGHT)
+        print(f"Batch {state['batch_id']} submitted.")
+    else:
+        return []
+
+    batch = wait_for_batch(state["batch_id"])
+    failed_files += split_results(batch, journal)
+
+    # Requests without any result line (e.g. an expired batch) also failed
+    for image_file in state["files"]:
+        if journal.state(image_file) not in (DONE, FAILED):
+            journal.record(image_file, FAILED, error=BatchError(f"batch {batch['status']} without a result"))
+            failed_files.append(image_file)
+
+    os.remove(BATCH_STATE_PATH)
+    return failed_files
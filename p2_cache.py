@@ -0,0 +1,99 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+import p0_configuration as configuration
+
+# Location and maximum size of the response cache (can be overwritten in p0_configuration.py)
+CACHE_PATH = getattr(configuration, "CACHE_PATH", "api_cache.sqlite")
+CACHE_MAX_SIZE_MB = getattr(configuration, "CACHE_MAX_SIZE_MB", 500)
+
+
+def make_cache_key(image_bytes, instructions, model, max_tokens, options=""):
+    """Hash everything that defines the answer of an API call (options describe how the image is preprocessed)."""
+    digest = hashlib.sha256()
+    digest.update(hashlib.sha256(image_bytes).digest())
+    digest.update(instructions.encode('utf-8'))
+    digest.update(f"\0{model}\0{max_tokens}\0{options}".encode('utf-8'))
+    return digest.hexdigest()
+
+
+class ResponseCache:
+    """Persistent SQLite cache of API responses, evicting the least recently used when too big."""
+
+    def __init__(self, path, max_size_bytes):
+        self.lock = threading.Lock()
+        self.max_size_bytes = max_size_bytes
+        self.hits = 0
+        self.misses = 0
+
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                response TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                last_access REAL NOT NULL
+            )
+        """)
+        self.connection.execute("CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)")
+        self.connection.commit()
+
+    def get(self, key):
+        """Return the cached response data, or None on a miss."""
+        with self.lock:
+            row = self.connection.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.connection.execute("UPDATE responses SET last_access = ? WHERE key = ?", (time.time(), key))
+            self.connection.commit()
+            return json.loads(row[0])
+
+    def put(self, key, data):
+        response = json.dumps(data, ensure_ascii=False)
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO responses (key, response, size, last_access) VALUES (?, ?, ?, ?)",
+                (key, response, len(response.encode('utf-8')), time.time()))
+            self._evict()
+            self.connection.commit()
+
+    def _evict(self):
+        # Remove the least recently used responses until the cache fits its size
+        total_size = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total_size <= self.max_size_bytes:
+            return
+
+        rows = self.connection.execute("SELECT key, size FROM responses ORDER BY last_access").fetchall()
+        for key, size in rows:
+            if total_size <= self.max_size_bytes:
+                break
+            self.connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+            total_size -= size
+
+    def report(self):
+        with self.lock:
+            entries, total_size = self.connection.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+
+        lookups = self.hits + self.misses
+        hit_rate = 100 * self.hits / lookups if lookups else 0
+        print(f"Cache: {self.hits} hits, {self.misses} misses ({hit_rate:.0f}% hit rate). "
+              f"{entries} responses stored, {total_size / 1e6:.1f} MB.")
+
+
+_shared_cache = None
+_shared_cache_lock = threading.Lock()
+
+
+def get_shared_cache():
+    """Return the process-wide response cache."""
+    global _shared_cache
+    with _shared_cache_lock:
+        if _shared_cache is None:
+            _shared_cache = ResponseCache(CACHE_PATH, CACHE_MAX_SIZE_MB * 1e6)
+        return _shared_cache
@@ -0,0 +1,200 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+import cv2
+import numpy as np
+
+import p0_configuration as configuration
+
+# Index of the questions already solved, by perceptual hash of their crop. Kept next to the scripts, so the exams of all
+# workspaces (scheduler.py) share it
+DEDUP_INDEX_PATH = getattr(configuration, "DEDUP_INDEX_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "questions_index.sqlite"))
+
+# Perceptual hash of the crops: "phash" (low frequencies of the DCT) or "dhash" (gradients), of DEDUP_HASH_SIZE² bits
+DEDUP_HASH = getattr(configuration, "DEDUP_HASH", "phash")
+DEDUP_HASH_SIZE = getattr(configuration, "DEDUP_HASH_SIZE", 16)
+
+# Crops whose hashes differ in at most this many bits are the same question
+DEDUP_MAX_DISTANCE = getattr(configuration, "DEDUP_MAX_DISTANCE", 6)
+
+# List the reused answers in DUPLICATES_PATH, to be checked by hand
+DEDUP_REVIEW = getattr(configuration, "DEDUP_REVIEW", True)
+DUPLICATES_PATH = os.path.join("api_responses", "duplicates.jsonl")
+
+
+def perceptual_hash(image_path, method=DEDUP_HASH, hash_size=DEDUP_HASH_SIZE):
+    """Hash of the crop as an integer, nearly the same for the same question scanned or cropped slightly differently."""
+    image = cv2.imread(image_path, cv2.IMREAD_GRAYSCALE)
+    if image is None:
+        raise ValueError(f"Unable to read {image_path}")
+
+    # Only the content counts: the margins left around it change with every crop
+    ink = cv2.threshold(image, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)[1]
+    points = cv2.findNonZero(ink)
+    if points is not None:
+        x, y, width, height = cv2.boundingRect(points)
+        image = image[y:y + height, x:x + width]
+
+    if method == "dhash":
+        # Whether each pixel is brighter than the one to its right
+        small = cv2.resize(image, (hash_size + 1, hash_size), interpolation=cv2.INTER_AREA).astype(np.int16)
+        bits = small[:, 1:] > small[:, :-1]
+    else:
+        # Whether each low frequency is above the median of them (without the mean, in the corner)
+        small = cv2.resize(image, (hash_size * 4, hash_size * 4), interpolation=cv2.INTER_AREA).astype(np.float32)
+        low_frequencies = cv2.dct(small)[:hash_size, :hash_size]
+        bits = low_frequencies > np.median(low_frequencies.flatten()[1:])
+
+    return int(''.join('1' if bit else '0' for bit in bits.flatten()), 2)
+
+
+def hamming(a, b):
+    return bin(a ^ b).count('1')
+
+
+class BKTree:
+    """Metric tree of hashes: a search only visits the branches that can hold a hash within the distance, not the whole corpus."""
+
+    def __init__(self):
+        # Each node is (hash, items with that hash, {distance: child})
+        self.root = None
+
+    def add(self, value, item):
+        if self.root is None:
+            self.root = (value, [item], {})
+            return
+
+        node = self.root
+        while True:
+            distance = hamming(value, node[0])
+            if distance == 0:
+                node[1].append(item)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = (value, [item], {})
+                return
+            node = child
+
+    def search(self, value, max_distance):
+        """Return (distance, item) of every hash within max_distance, closest first."""
+        results = []
+        stack = [self.root] if self.root is not None else []
+        while stack:
+            node_value, items, children = stack.pop()
+            distance = hamming(value, node_value)
+            if distance <= max_distance:
+                results += [(distance, item) for item in items]
+
+            # By the triangle inequality, only these children can be close enough
+            for child_distance, child in children.items():
+                if distance - max_distance <= child_distance <= distance + max_distance:
+                    stack.append(child)
+
+        return sorted(results, key=lambda result: result[0])
+
+
+def group_near_duplicates(files, max_distance=DEDUP_MAX_DISTANCE, method=DEDUP_HASH, hash_size=DEDUP_HASH_SIZE):
+    """Split the files into groups of crops within max_distance of the first one of their group, keeping their order."""
+    tree = BKTree()
+    groups = []
+    for image_file in files:
+        try:
+            value = perceptual_hash(image_file, method, hash_size)
+        except ValueError:
+            groups.append([image_file])
+            continue
+
+        matches = tree.search(value, max_distance)
+        if matches:
+            groups[matches[0][1]].append(image_file)
+        else:
+            tree.add(value, len(groups))
+            groups.append([image_file])
+    return groups
+
+
+class QuestionIndex:
+    """Persistent SQLite table of the solved questions and their hashes, searched through a BK-tree built when it is opened.
+
+    The questions added since then by other processes (the other exams of scheduler.py) are read before each search.
+    """
+
+    def __init__(self, path, method=DEDUP_HASH, hash_size=DEDUP_HASH_SIZE):
+        self.lock = threading.Lock()
+        self.method = method
+        self.hash_size = hash_size
+        # Hashes of another kind or size can't be compared
+        self.kind = f"{method}{hash_size}"
+        self.tree = BKTree()
+        self.known = set()
+        self.last_row = 0
+
+        self.connection = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS questions (
+                image_sha TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                hash TEXT NOT NULL,
+                image TEXT NOT NULL,
+                question TEXT NOT NULL,
+                time REAL NOT NULL,
+                PRIMARY KEY (image_sha, kind)
+            )
+        """)
+        self.connection.commit()
+
+        with self.lock:
+            self._read_new_rows()
+
+    def _read_new_rows(self):
+        rows = self.connection.execute("SELECT rowid, image_sha, hash FROM questions WHERE kind = ? AND rowid > ? ORDER BY rowid",
+                                       (self.kind, self.last_row)).fetchall()
+        for row, image_sha, value in rows:
+            self.last_row = row
+            # A question replaced with a new answer keeps its place in the tree
+            if image_sha not in self.known:
+                self.known.add(image_sha)
+                self.tree.add(int(value, 16), image_sha)
+
+    def find(self, image_path, max_distance=DEDUP_MAX_DISTANCE):
+        """Return (distance, image, question JSON) of the closest solved question within max_distance, or None."""
+        value = perceptual_hash(image_path, self.method, self.hash_size)
+        with self.lock:
+            self._read_new_rows()
+            matches = self.tree.search(value, max_distance)
+            if not matches:
+                return None
+            distance, image_sha = matches[0]
+            image, question = self.connection.execute(
+                "SELECT image, question FROM questions WHERE image_sha = ? AND kind = ?", (image_sha, self.kind)).fetchone()
+        return distance, image, question
+
+    def add(self, image_path, question):
+        """Keep the question JSON (text) of a crop solved by the API."""
+        value = perceptual_hash(image_path, self.method, self.hash_size)
+        with open(image_path, 'rb') as file:
+            image_sha = hashlib.sha256(file.read()).hexdigest()
+
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO questions (image_sha, kind, hash, image, question, time) VALUES (?, ?, ?, ?, ?, ?)",
+                (image_sha, self.kind, format(value, 'x'), os.path.abspath(image_path), question, time.time()))
+            self.connection.commit()
+            self._read_new_rows()
+
+
+_shared_index = None
+_shared_index_lock = threading.Lock()
+
+
+def get_shared_index():
+    """Return the process-wide index of solved questions."""
+    global _shared_index
+    with _shared_index_lock:
+        if _shared_index is None:
+            _shared_index = QuestionIndex(DEDUP_INDEX_PATH)
+        return _shared_index
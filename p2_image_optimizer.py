@@ -0,0 +1,116 @@
+import math
+import os
+
+import cv2
+
+import p0_configuration as configuration
+
+# Image preprocessing before the API call (can be overwritten in p0_configuration.py)
+IMAGE_DETAIL = getattr(configuration, "IMAGE_DETAIL", "high")             # "low", "high" or "auto"
+IMAGE_MAX_LONG_EDGE = getattr(configuration, "IMAGE_MAX_LONG_EDGE", None)  # pixels
+IMAGE_PIXEL_BUDGET = getattr(configuration, "IMAGE_PIXEL_BUDGET", None)    # width * height
+IMAGE_MAX_TOKENS = getattr(configuration, "IMAGE_MAX_TOKENS", None)        # vision tokens per image
+IMAGE_GRAYSCALE = getattr(configuration, "IMAGE_GRAYSCALE", False)
+IMAGE_DENOISE = getattr(configuration, "IMAGE_DENOISE", False)
+IMAGE_BINARIZE = getattr(configuration, "IMAGE_BINARIZE", False)
+IMAGE_FORMAT = getattr(configuration, "IMAGE_FORMAT", "jpeg")              # "jpeg", "webp" or "png"
+IMAGE_QUALITY = getattr(configuration, "IMAGE_QUALITY", 85)
+
+# Formats accepted by the API as they are
+MIME_TYPES = {".jpg": "image/jpeg", ".jpeg": "image/jpeg", ".png": "image/png", ".webp": "image/webp", ".gif": "image/gif"}
+
+
+def api_resized_size(width, height, detail=IMAGE_DETAIL):
+    """Size the API itself scales an image to before counting its tokens (sending more pixels is wasted)."""
+    if detail == "low":
+        scale = min(1, 512 / max(width, height))
+    else:
+        # Fit in a 2048 x 2048 square, then make the shortest side at most 768
+        scale = min(1, 2048 / max(width, height))
+        shortest_side = min(width, height) * scale
+        if shortest_side > 768:
+            scale *= 768 / shortest_side
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def vision_token_cost(width, height, detail=IMAGE_DETAIL):
+    """Tokens charged for an image: 85 base tokens plus 170 per 512px tile in high detail."""
+    if detail == "low":
+        return 85
+
+    width, height = api_resized_size(width, height, detail)
+    tiles = math.ceil(width / 512) * math.ceil(height / 512)
+    return 85 + 170 * tiles
+
+
+def choose_size(width, height):
+    """Pick the output size from the API resizing, the configured limits and the token budget."""
+    new_width, new_height = api_resized_size(width, height)
+
+    scale = 1.0
+    if IMAGE_MAX_LONG_EDGE:
+        scale = min(scale, IMAGE_MAX_LONG_EDGE / max(new_width, new_height))
+    if IMAGE_PIXEL_BUDGET:
+        scale = min(scale, math.sqrt(IMAGE_PIXEL_BUDGET / (new_width * new_height)))
+    new_width, new_height = max(1, round(new_width * scale)), max(1, round(new_height * scale))
+
+    # Shrink until the image fits in fewer tiles, if a token budget is set
+    while IMAGE_MAX_TOKENS and vision_token_cost(new_width, new_height) > IMAGE_MAX_TOKENS and max(new_width, new_height) > 64:
+        new_width, new_height = max(1, int(new_width * 0.95)), max(1, int(new_height * 0.95))
+
+    return new_width, new_height
+
+
+def settings_fingerprint():
+    """Text describing the preprocessing, so that a change in the settings also changes the cache key."""
+    return (f"detail={IMAGE_DETAIL};long_edge={IMAGE_MAX_LONG_EDGE};pixels={IMAGE_PIXEL_BUDGET};tokens={IMAGE_MAX_TOKENS};"
+            f"gray={IMAGE_GRAYSCALE};denoise={IMAGE_DENOISE};binarize={IMAGE_BINARIZE};format={IMAGE_FORMAT};quality={IMAGE_QUALITY}")
+
+
+def encode_array(image):
+    if IMAGE_FORMAT == "webp":
+        success, buffer = cv2.imencode(".webp", image, [cv2.IMWRITE_WEBP_QUALITY, IMAGE_QUALITY])
+        mime_type = "image/webp"
+    elif IMAGE_FORMAT == "png":
+        success, buffer = cv2.imencode(".png", image, [cv2.IMWRITE_PNG_COMPRESSION, 9])
+        mime_type = "image/png"
+    else:
+        success, buffer = cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, IMAGE_QUALITY, cv2.IMWRITE_JPEG_OPTIMIZE, 1])
+        mime_type = "image/jpeg"
+
+    if not success:
+        raise ValueError(f"Could not encode image as {IMAGE_FORMAT}")
+    return buffer.tobytes(), mime_type
+
+
+def optimize_image(image_path):
+    """Return the bytes to upload for an image, their MIME type and the vision tokens they cost."""
+    with open(image_path, "rb") as image_file:
+        original_bytes = image_file.read()
+
+    image = cv2.imread(image_path, cv2.IMREAD_COLOR)
+    if image is None:
+        raise ValueError(f"Could not read image {image_path}")
+
+    height, width = image.shape[:2]
+    new_width, new_height = choose_size(width, height)
+    image_tokens = vision_token_cost(new_width, new_height)
+
+    # Nothing to change: upload the original file as it is
+    extension = os.path.splitext(image_path)[1].lower()
+    filters = IMAGE_GRAYSCALE or IMAGE_DENOISE or IMAGE_BINARIZE
+    if (new_width, new_height) == (width, height) and not filters and extension in MIME_TYPES:
+        return original_bytes, MIME_TYPES[extension], image_tokens
+
+    if (new_width, new_height) != (width, height):
+        image = cv2.resize(image, (new_width, new_height), interpolation=cv2.INTER_AREA)
+
+    if filters:
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    if IMAGE_DENOISE:
+        image = cv2.fastNlMeansDenoising(image, None, h=10)
+    if IMAGE_BINARIZE:
+        image = cv2.adaptiveThreshold(image, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 31, 15)
+
+    image_bytes, mime_type = encode_array(image)
+    return image_bytes, mime_type, image_tokens
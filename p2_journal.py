@@ -0,0 +1,140 @@
+import json
+import os
+import random
+import threading
+import time
+
+import p0_configuration as configuration
+
+# Journal location and retry policy (can be overwritten in p0_configuration.py)
+JOURNAL_PATH = getattr(configuration, "JOURNAL_PATH", os.path.join("api_responses", "journal.jsonl"))
+MAX_RETRIES = getattr(configuration, "MAX_RETRIES", 5)
+RETRY_BASE_DELAY = getattr(configuration, "RETRY_BASE_DELAY", 2)
+RETRY_MAX_DELAY = getattr(configuration, "RETRY_MAX_DELAY", 60)
+
+# Possible states of each image
+PENDING = "pending"
+IN_FLIGHT = "in_flight"
+DONE = "done"
+FAILED = "failed"
+
+
+def backoff_delay(attempt):
+    """Exponential backoff with full jitter for the given attempt number (starting at 1)."""
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+
+
+def file_signature(image_file):
+    # Size and modification time tell if a crop was re-generated since it was solved
+    stat = os.stat(image_file)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+class JobJournal:
+    """Append-only JSONL record of the state of each image, so that an interrupted run can be resumed."""
+
+    def __init__(self, path, listener=None):
+        self.lock = threading.Lock()
+        self.entries = {}
+
+        # Called with (file, state, attempts) after each record, e.g. by the run metrics
+        self.listener = listener
+
+        folder = os.path.dirname(path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+
+        # Replay the journal: the last line of each image is its current state
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as file:
+                for line in file:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # Line cut in half by a crash
+                        continue
+                    self.entries[entry["file"]] = entry
+
+        self.file = open(path, 'a', encoding='utf-8')
+
+    def record(self, image_file, state, error=None):
+        with self.lock:
+            previous = self.entries.get(image_file, {})
+
+            # Queuing an image again starts its retry count over
+            attempts = 0 if state == PENDING else previous.get("attempts", 0)
+            if state == IN_FLIGHT:
+                attempts += 1
+
+            entry = {"file": image_file, "state": state, "attempts": attempts, "time": time.time()}
+            if error is not None:
+                entry["error_class"] = type(error).__name__
+                entry["error"] = str(error)
+            if state == DONE:
+                entry["signature"] = file_signature(image_file)
+
+            # The model tier reached is kept for the retries, unless the crop was solved and then re-generated
+            if "tier" in previous and not (state == PENDING and previous["state"] == DONE):
+                entry["tier"] = previous["tier"]
+
+            self._write(entry)
+
+        if self.listener is not None:
+            self.listener(image_file, state, attempts)
+
+    def record_tier(self, image_file, model):
+        """Note that the image was escalated to the tier of model, so its retries start there."""
+        with self.lock:
+            entry = dict(self.entries.get(image_file, {"file": image_file, "state": IN_FLIGHT, "attempts": 0}))
+            entry.pop("error_class", None)
+            entry.pop("error", None)
+            entry.update({"tier": model, "time": time.time()})
+            self._write(entry)
+
+    def _write(self, entry):
+        self.entries[entry["file"]] = entry
+        self.file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        self.file.flush()
+
+    def state(self, image_file):
+        with self.lock:
+            return self.entries.get(image_file, {}).get("state")
+
+    def attempts(self, image_file):
+        with self.lock:
+            return self.entries.get(image_file, {}).get("attempts", 0)
+
+    def tier(self, image_file):
+        """The model of the tier the image was escalated to, or None."""
+        with self.lock:
+            return self.entries.get(image_file, {}).get("tier")
+
+    def files_to_process(self, files, retry_failed=False):
+        """Return the files that still need an API call, marking new ones as pending."""
+        remaining = []
+        for image_file in files:
+            entry = self.entries.get(image_file)
+
+            if entry is None:
+                self.record(image_file, PENDING)
+            elif entry["state"] == DONE and entry.get("signature") == file_signature(image_file):
+                continue
+            elif entry["state"] == FAILED and entry["attempts"] >= MAX_RETRIES and not retry_failed:
+                continue
+            elif entry["state"] != PENDING:
+                # Unfinished, interrupted or re-generated since it was solved: start it over
+                self.record(image_file, PENDING)
+
+            remaining.append(image_file)
+
+        return remaining
+
+    def summary(self):
+        counts = {}
+        with self.lock:
+            for entry in self.entries.values():
+                counts[entry["state"]] = counts.get(entry["state"], 0) + 1
+        return counts
+
+    def close(self):
+        self.file.close()
@@ -1,38 +1,105 @@
+import argparse
 import base64
 import requests
 import json
 import os
 import concurrent.futures
 import sys
-import time
-import threading
 import re
+import time
 
+import p0_configuration as configuration
 from p0_configuration import API_KEY
 from p0_configuration import MAX_TOKENS_PER_API_CALL
-from p0_assistant_instructions import assistant_instructions
+from p0_assistant_instructions import assistant_instructions, repair_instructions
+from p2_cache import get_shared_cache, make_cache_key
+from p2_dedup import DEDUP_MAX_DISTANCE, DEDUP_REVIEW, DUPLICATES_PATH, get_shared_index, group_near_duplicates
+from p2_image_optimizer import IMAGE_DETAIL, optimize_image, settings_fingerprint
+from p2_journal import DONE, FAILED, IN_FLIGHT, JOURNAL_PATH, MAX_RETRIES, JobJournal, backoff_delay
+from p2_metrics import METRICS_CSV_PATH, METRICS_JSON_PATH, get_shared_metrics, print_summary
+from p2_rate_limiter import get_shared_limiter
+from p2_routing import MODEL, escalation_reason, routing_fingerprint, tier_limiter, tiers_for
+from p2_schema import QUESTION_SCHEMA, InvalidAnswer, parse_question, repair_json
+from p2_stream_parser import IncrementalJSONParser
 
-# Function to encode the image
-def encode_image(image_path):
-  with open(image_path, "rb") as image_file:
-    return base64.b64encode(image_file.read()).decode('utf-8')
+# Reuse earlier responses to identical requests (disabled with --no-cache)
+USE_CACHE = getattr(configuration, "USE_CACHE", True)
 
+# Receive the completions as a stream (enabled with --stream)
+USE_STREAM = getattr(configuration, "USE_STREAM", False)
 
+# Reuse the answer of an already solved question when a crop looks the same (enabled with --dedup, see p2_dedup.py)
+USE_DEDUP = getattr(configuration, "USE_DEDUP", False)
 
-def gpt_request(image_path):
-    print(f"Making request for OpenAI API...")
+# Number of threads in the ThreadPoolExecutor (the rate limiter keeps them under the API quota)
+MAX_WORKERS = getattr(configuration, "MAX_WORKERS", 8)
 
-    # Getting the base64 string
-    base64_image = encode_image(image_path)
+# Ask the API for JSON output: None, "json_object" (JSON mode) or "json_schema" (QUESTION_SCHEMA), for the models that support it
+RESPONSE_FORMAT = getattr(configuration, "RESPONSE_FORMAT", None)
 
-    headers = {
+# Answers that are not valid even after the local repair are sent back (without the image) to be corrected
+REASK_INVALID_ANSWERS = getattr(configuration, "REASK_INVALID_ANSWERS", True)
+
+# OpenAI endpoints (the base URL can point to mock_openai_server.py for tests)
+API_BASE_URL = getattr(configuration, "API_BASE_URL", "https://api.openai.com/v1")
+API_URL = f"{API_BASE_URL}/chat/completions"
+
+# Seconds before giving up on a single API call (a hung connection would otherwise hold its worker forever)
+REQUEST_TIMEOUT = getattr(configuration, "REQUEST_TIMEOUT", 300)
+
+# Function to encode the image (resized and filtered as configured in p2_image_optimizer)
+def encode_image(image_path):
+  image_bytes, mime_type, image_tokens = optimize_image(image_path)
+  return base64.b64encode(image_bytes).decode('utf-8'), mime_type, image_tokens
+
+def estimate_request_tokens(payload, image_tokens):
+    """Estimate the tokens counted against the quota: prompt text, images and max_tokens."""
+    estimate = payload["max_tokens"] + image_tokens
+    for message in payload["messages"]:
+        for part in message["content"]:
+            if part["type"] == "text":
+                # Roughly 4 characters per token
+                estimate += len(part["text"]) // 4
+    return estimate
+
+def pause_on_rate_limit(status_code, headers, data, limiter):
+    """Pause all workers when the API answers that the rate limit was exceeded."""
+    if status_code != 429:
+        return
+
+    # Regular expression to extract the time from the error message
+    try:
+        response_message = data["error"]["message"]
+    except (KeyError, TypeError):
+        response_message = ""
+    match = re.search(r'Please try again in ([\d.]+)(ms|s)', response_message)
+
+    if match:
+        wait_time = float(match.group(1)) / (1000 if match.group(2) == "ms" else 1)
+    else:
+        wait_time = float(headers.get("retry-after", 1))
+
+    # Round it and pause every worker sharing the limiter
+    limiter.pause(int(wait_time) + 1)
+
+def release_unused_tokens(limiter, estimated_tokens, data):
+    """Give back to the limiter the tokens that were reserved but not used."""
+    try:
+        used_tokens = data["usage"]["total_tokens"]
+    except (KeyError, TypeError):
+        return
+    limiter.refund(estimated_tokens - used_tokens)
+
+def request_headers():
+    return {
     "Content-Type": "application/json",
     "Authorization": f"Bearer {API_KEY}"
     }
 
+def build_payload(base64_image, mime_type, model=MODEL):
     # Define parameters for API call
-    payload = {
-    "model": "gpt-4-vision-preview",
+    return {
+    "model": model,
     "messages": [
         {
         "role": "user",
@@ -44,53 +111,223 @@ def gpt_request(image_path):
             {
             "type": "image_url",
             "image_url": {
-                "url": f"data:image/jpeg;base64,{base64_image}"
+                "url": f"data:{mime_type};base64,{base64_image}",
+                "detail": IMAGE_DETAIL
             }
             }
         ]
         }
     ],
-    "max_tokens": MAX_TOKENS_PER_API_CALL
+    "max_tokens": MAX_TOKENS_PER_API_CALL,
+    **response_format()
     }
 
+def response_format():
+    """The response_format parameter of the requests, as configured in RESPONSE_FORMAT."""
+    if RESPONSE_FORMAT == "json_object":
+        return {"response_format": {"type": "json_object"}}
+    if RESPONSE_FORMAT == "json_schema":
+        # Not strict: the alternatives of "resposta" have free keys, which strict mode does not allow
+        return {"response_format": {"type": "json_schema", "json_schema": {"name": "questao", "schema": QUESTION_SCHEMA, "strict": False}}}
+    return {}
+
+def cache_key_for(image_path):
+    options = settings_fingerprint()
+    if RESPONSE_FORMAT:
+        options += f"|response_format={RESPONSE_FORMAT}"
+    with open(image_path, "rb") as image_file:
+        return make_cache_key(image_file.read(), assistant_instructions, routing_fingerprint(), MAX_TOKENS_PER_API_CALL, options)
+
+def cached_response(image_path):
+    """Return the response of an identical earlier request, or None."""
+    if not USE_CACHE:
+        return None
+
+    data = get_shared_cache().get(cache_key_for(image_path))
+    if data is not None:
+        print(f"Using cached response: image {image_path}")
+    return data
+
+def store_in_cache(image_path, data):
+    if USE_CACHE:
+        get_shared_cache().put(cache_key_for(image_path), data)
+
+def write_partial_enunciado(img_name, enunciado):
+    """Save the 'enunciado' of a question that is still being streamed (replaced by the full JSON when it arrives)."""
+    output_folder = 'output_1_jsons'
+    if not os.path.exists(output_folder):
+        os.makedirs(output_folder)
 
-    # Deal with OpenAI API Rate Limits
-    semaphore = threading.Semaphore(MAX_REQUESTS_PER_MINUTE)
-
-    with semaphore:
-
-        # Make API call 
-        response = requests.post("https://api.openai.com/v1/chat/completions", headers=headers, json=payload)
-
-        # Wait to respect the rate limit
-        # Calculate the necessary delay
-        requests_per_worker_per_minute = MAX_REQUESTS_PER_MINUTE / MAX_WORKERS
-
-        time.sleep(60 / requests_per_worker_per_minute)
-
-        return response
-
-def save_data_as_json(img_name, data):
-    print(f"Saving data as JSON: image {img_name}")
+    with open(os.path.join(output_folder, img_name) + ".json.partial", 'w', encoding='utf-8') as file:
+        json.dump({"enunciado": enunciado}, file, indent=2, ensure_ascii=False)
+
+def remove_partial_enunciado(img_name):
+    """Delete the streamed 'enunciado', once the full JSON is saved or the request failed."""
+    partial_path = os.path.join('output_1_jsons', img_name) + ".json.partial"
+    if os.path.exists(partial_path):
+        os.remove(partial_path)
+
+def stream_completion(payload, image_path):
+    """Make the API call with stream=True, saving the 'enunciado' as soon as it arrives and stopping once the JSON is complete."""
+    img_name = image_name(image_path)
+    payload = dict(payload, stream=True, stream_options={"include_usage": True})
+
+    def on_field(field, value):
+        if field == "enunciado":
+            write_partial_enunciado(img_name, value)
+
+    parser = IncrementalJSONParser(on_field)
+    content = []
+    choice = {"index": 0, "message": {"role": "assistant", "content": ""}, "finish_reason": None}
+    data = {"choices": [choice]}
+
+    start_time = time.monotonic()
+    first_token_time = None
+
+    response = requests.post(API_URL, headers=request_headers(), json=payload, stream=True, timeout=REQUEST_TIMEOUT)
+    if response.status_code != 200:
+        return response, response.json()
+
+    # Server-sent events: one "data: {...}" line per chunk, until "data: [DONE]"
+    response.encoding = 'utf-8'
+    with response:
+        for line in response.iter_lines(decode_unicode=True):
+            if not line or not line.startswith("data:"):
+                continue
+            event = line[len("data:"):].strip()
+            if event == "[DONE]":
+                break
+
+            chunk = json.loads(event)
+            data["id"] = chunk.get("id")
+            data["model"] = chunk.get("model")
+            if chunk.get("usage"):
+                data["usage"] = chunk["usage"]
+
+            for chunk_choice in chunk.get("choices", []):
+                delta = (chunk_choice.get("delta") or {}).get("content")
+                if delta:
+                    if first_token_time is None:
+                        first_token_time = time.monotonic()
+                    content.append(delta)
+                    parser.feed(delta)
+                if chunk_choice.get("finish_reason"):
+                    choice["finish_reason"] = chunk_choice["finish_reason"]
+
+            # The JSON is complete: don't wait for the rest of the stream
+            if parser.complete:
+                choice["finish_reason"] = choice["finish_reason"] or "stop"
+                break
+
+    total_time = time.monotonic() - start_time
+    time_to_first_token = (first_token_time - start_time) if first_token_time else None
+    choice["message"]["content"] = "".join(content)
+    data["stream_timing"] = {"time_to_first_token": time_to_first_token, "total_time": total_time}
+
+    first_token = f"{time_to_first_token:.2f}s" if time_to_first_token is not None else "never"
+    print(f"Streamed {img_name}: first token after {first_token}, total {total_time:.2f}s")
+
+    return response, data
+
+def gpt_request(image_path, journal=None):
+    """Solve the image with the first model of its tiers (see p2_routing.py), asking the next one while the answer can't be used.
+
+    With a journal, the tier reached is recorded there and a retry starts from it instead of the cheaper ones.
+    """
+    # Skip the API call for images that were already solved
+    data = cached_response(image_path)
+    if data is not None:
+        return data
+
+    tiers = tiers_for(image_path, journal.tier(image_path) if journal is not None else None)
+    for i, tier in enumerate(tiers):
+        data = model_request(image_path, tier)
+
+        reason = escalation_reason(data) if i < len(tiers) - 1 else None
+        if reason is None:
+            return data
+        print(f"Escalating {image_path} from {tier['model']} to {tiers[i + 1]['model']}: {reason}")
+        if journal is not None:
+            journal.record_tier(image_path, tiers[i + 1]["model"])
+
+def model_request(image_path, tier):
+    """Make the API call for one image with the model of the tier, within its rate budget."""
+    print(f"Making request for OpenAI API...")
 
-    # Extract the 'choices' field from the response
-    choices_data = data['choices']
+    # Getting the base64 string
+    start_time = time.perf_counter()
+    base64_image, mime_type, image_tokens = encode_image(image_path)
+    payload = build_payload(base64_image, mime_type, tier["model"])
+    encode_seconds = time.perf_counter() - start_time
+
+    return post_completion(payload, tier_limiter(tier), tier["model"], "solve", [image_name(image_path)], image_tokens,
+                           encode_seconds, stream_path=image_path if USE_STREAM else None)
+
+def post_completion(payload, limiter, model, kind, images, image_tokens=0, encode_seconds=None, stream_path=None):
+    """Make one chat request within the rate budget of limiter, recording its metrics and adjusting the budget with what the
+    API reports. With stream_path, the answer is streamed for that image. Return the response data."""
+    body = json.dumps(payload).encode('utf-8')
+
+    # Deal with OpenAI API Rate Limits: wait for room in the shared budget of the model
+    estimated_tokens = estimate_request_tokens(payload, image_tokens)
+    start_time = time.perf_counter()
+    limiter.acquire(estimated_tokens)
+    queue_seconds = time.perf_counter() - start_time
+
+    # Make API call 
+    start_time = time.perf_counter()
+    if stream_path is not None:
+        response, data = stream_completion(payload, stream_path)
+
+        # Streams stopped as soon as the JSON was complete end before the usage: estimate it
+        if response.status_code == 200 and not data.get("usage"):
+            prompt_tokens = estimated_tokens - payload["max_tokens"]
+            completion_tokens = len(data["choices"][0]["message"]["content"]) // 4
+            data["usage"] = {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                             "total_tokens": prompt_tokens + completion_tokens, "estimated": True}
+    else:
+        response = requests.post(API_URL, headers=request_headers(), data=body, timeout=REQUEST_TIMEOUT)
+        data = response.json()
+    latency_seconds = time.perf_counter() - start_time
+
+    get_shared_metrics().record_request(images, kind, data, response.status_code, encode_seconds, queue_seconds,
+                                        latency_seconds, len(body), model)
+
+    # Adjust the budget with what the API reports
+    limiter.update_from_headers(response.headers)
+    pause_on_rate_limit(response.status_code, response.headers, data, limiter)
+    release_unused_tokens(limiter, estimated_tokens, data)
+
+    return data
+
+def reask_for_json(text, errors, images=()):
+    """Send an invalid answer back to be corrected, without the image. Return the content of the new answer."""
+    prompt = (repair_instructions
+              + "\nJSON Schema:\n" + json.dumps(QUESTION_SCHEMA, ensure_ascii=False)
+              + "\nMotivos:\n" + "\n".join(f"- {error}" for error in errors)
+              + "\nTexto:\n" + text)
+    payload = {
+        "model": MODEL,
+        "messages": [{"role": "user", "content": [{"type": "text", "text": prompt}]}],
+        "max_tokens": MAX_TOKENS_PER_API_CALL,
+        **response_format()
+    }
 
-    # Define the content string
-    content = choices_data[0]['message']['content']
+    data = post_completion(payload, get_shared_limiter(), MODEL, "reask", list(images))
 
-    # Clean content string
-    content = content.replace("```", "")
-    content = content.replace("json", "")
-    content = content.replace("\n", "")
+    if "error" in data:
+        raise APIError(f"{data['error'].get('code')}: {data['error'].get('message')}")
+    return data['choices'][0]['message']['content']
 
-    # Transform content string to JSON
+def parse_content(content):
+    """Transform the content string of a completion into JSON, repairing the usual mistakes (see p2_schema.py)."""
     try:
-        # Attempt to load the string as JSON
-        parsed_json = json.loads(content, strict=False)
-    except json.JSONDecodeError as e:
+        return repair_json(content)
+    except InvalidAnswer as e:
         print(f"Error decoding JSON: {e}")
+        raise
 
+def write_question_json(img_name, parsed_json):
     # Create output folder (if it already does no exist) for the JSON files
     output_folder = 'output_1_jsons'
     if not os.path.exists(output_folder):
@@ -106,115 +343,296 @@ def save_data_as_json(img_name, data):
     with open(filename, 'w', encoding='utf-8') as file:
         json.dump(parsed_json, file, indent=2, ensure_ascii=False)
 
-def user_check(message):
-    check = input(message)
+    # The streamed 'enunciado' is no longer needed
+    remove_partial_enunciado(img_name)
 
-    if check.lower() != "y":
-        print("Python script terminated by user.")
-        sys.exit()   
+def save_data_as_json(img_name, data):
+    """Validate and save the question of a response. Return the response, with the corrected answer if it had to be asked again."""
+    print(f"Saving data as JSON: image {img_name}")
 
-if __name__ == "__main__":
+    # Extract the 'choices' field from the response
+    choices_data = data['choices']
 
-    # Path to your images
-    images_path = "output_0_areas"
+    # Define the content string
+    content = choices_data[0]['message']['content']
 
+    # The rest of a cut off answer can't be rebuilt from its text: the image has to be solved again
+    if choices_data[0].get('finish_reason') == 'length':
+        raise TruncatedAnswer(f"The answer for image {img_name} was cut off at max_tokens")
+
+    try:
+        question = parse_question(content)
+    except InvalidAnswer as e:
+        if not REASK_INVALID_ANSWERS:
+            raise
+        # Sending the text back is much cheaper than solving the image again
+        print(f"Invalid answer for image {img_name} ({e}), asking for a correction without the image...")
+        content = reask_for_json(e.text, e.errors, [img_name])
+        question = parse_question(content)
+        data = dict(data, choices=[dict(choices_data[0], message={"role": "assistant", "content": content})])
+
+    write_question_json(img_name, question)
+    return data
+
+class APIError(Exception):
+    """The API answered with an error instead of a completion."""
+
+class TruncatedAnswer(Exception):
+    """The answer was cut off at max_tokens."""
+
+def image_name(image_file):
+    # File name without folder and extension
+    file_name = os.path.basename(image_file)
+    file_name_without_extension, _ = os.path.splitext(file_name)
+    return file_name_without_extension
+
+def save_api_response(image_file, data):
+    # Save response for registering (and possible check of errors)
+    api_responses_folder = 'api_responses'
+    if not os.path.exists(api_responses_folder):
+        os.makedirs(api_responses_folder)
+    file_path = os.path.join(api_responses_folder, image_name(image_file)) + "_resp.json"
+    with open(file_path, 'w') as file:
+        json.dump(data, file, indent=4)
+
+def handle_response(image_file, data):
+    """Register the API response and save the question JSON for one image."""
+    save_api_response(image_file, data)
+
+    # Handle Error in response (rate limits already paused the workers in gpt_request)
+    if "error" in data:
+        raise APIError(f"{data['error'].get('code')}: {data['error'].get('message')}")
+
+    # Save the data as a JSON file
+    data = save_data_as_json(image_name(image_file), data)
+
+    # Only responses that could be saved are worth reusing
+    store_in_cache(image_file, data)
+    remember_question(image_file)
+
+def report_exception(image_file, exception):
+    print(f"\nThe following Exception occurred on the file: {image_file}\n  ")
+    print(exception)
+    print('\n')
+
+def solve_with_retries(image_file, journal):
+    """Make the API call for one image, retrying with exponential backoff until it works or MAX_RETRIES is reached."""
+    if solve_from_duplicate(image_file, journal):
+        return
+
+    while True:
+        journal.record(image_file, IN_FLIGHT)
+        try:
+            handle_response(image_file, gpt_request(image_file, journal))
+        except Exception as e:
+            report_exception(image_file, e)
+            # A failed answer must not be left in output_1_jsons as if it were a question
+            remove_partial_enunciado(image_name(image_file))
+            journal.record(image_file, FAILED, error=e)
+
+            attempts = journal.attempts(image_file)
+            if attempts >= MAX_RETRIES:
+                raise
+            delay = backoff_delay(attempts)
+            print(f"Retrying {image_file} in {delay:.1f}s (attempt {attempts + 1} of {MAX_RETRIES})")
+            time.sleep(delay)
+        else:
+            journal.record(image_file, DONE)
+            return
+
+def solve_from_cache(files, journal):
+    """Save the images already solved in the cache. Return the files that still need an API call."""
+    remaining = []
+    for image_file in files:
+        data = cached_response(image_file)
+        if data is None:
+            remaining.append(image_file)
+            continue
+        try:
+            handle_response(image_file, data)
+            journal.record(image_file, DONE)
+        except Exception as e:
+            report_exception(image_file, e)
+            remaining.append(image_file)
+    return remaining
+
+def remember_question(image_file):
+    """Add the saved question of an image solved by the API to the index of duplicates."""
+    if not USE_DEDUP:
+        return
+    with open(os.path.join('output_1_jsons', image_name(image_file)) + ".json", 'r', encoding='utf-8') as file:
+        get_shared_index().add(image_file, file.read())
+
+def flag_duplicate(image_file, duplicate_of, distance):
+    # One line per reused answer, to be checked by hand
+    if not os.path.exists('api_responses'):
+        os.makedirs('api_responses')
+    with open(DUPLICATES_PATH, 'a', encoding='utf-8') as file:
+        file.write(json.dumps({"image": image_file, "duplicate_of": duplicate_of, "distance": distance, "time": time.time()}) + "\n")
+
+def solve_from_duplicates(files, journal):
+    """Save the answer of an already solved question for the images that look the same. Return the files that still need an API call."""
+    remaining = []
+    for image_file in files:
+        try:
+            match = get_shared_index().find(image_file, DEDUP_MAX_DISTANCE)
+        except Exception as e:
+            report_exception(image_file, e)
+            match = None
+        if match is None:
+            remaining.append(image_file)
+            continue
+
+        distance, duplicate_of, question = match
+        print(f"Reusing the answer of {duplicate_of} for image {image_file} ({distance} bits apart)")
+        write_question_json(image_name(image_file), json.loads(question))
+        if DEDUP_REVIEW:
+            flag_duplicate(image_file, duplicate_of, distance)
+        journal.record(image_file, DONE)
+    return remaining
+
+def solve_from_duplicate(image_file, journal):
+    """Check the index again right before the request of an image, since the same question may have been solved meanwhile
+    (by this run or another exam). Return True if the image was answered from it."""
+    return USE_DEDUP and not solve_from_duplicates([image_file], journal)
+
+def duplicate_rounds(files):
+    """Order the requests so that only the first crop of each group of near-identical ones is sent: the others come in a
+    second round, answered from the index once the first one is solved (or sent if it failed)."""
+    groups = group_near_duplicates(files, DEDUP_MAX_DISTANCE)
+    return [[group[0] for group in groups], [image_file for group in groups for image_file in group[1:]]]
+
+def run_threaded(files, journal):
+    """Make the API calls with a pool of threads. Return the files that failed."""
+    failed_files = []
+
+    # Use ThreadPoolExecutor to make requests in parallel
+    with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        futures = {executor.submit(solve_with_retries, image_file, journal): image_file for image_file in files}
+        for future in concurrent.futures.as_completed(futures):
+            if future.exception() is not None:
+                failed_files.append(futures[future])
+
+    return failed_files
+
+def list_image_files(images_path):
     # List all files in the specified directory
     all_entries = os.listdir(images_path)
 
     # Filter images files and sort them alphabetically
-    image_filter = lambda file: file.endswith((".jpg", ".jpeg", ".png", ".bmp", ".tif", ".tiff"))
+    image_filter = lambda file: file.endswith((".jpg", ".jpeg", ".png", ".bmp", ".tif", ".tiff", ".webp"))
     images = list(filter(image_filter , all_entries))
     images = sorted(images)
 
-    # Define list of files for the multithread api calls
-    files = [os.path.join(images_path, f) for f in images]
+    return [os.path.join(images_path, f) for f in images]
 
+def user_check(message):
+    check = input(message)
 
-    # Create a folder to register api responses 
-    api_responses_folder = 'api_responses'
-    if not os.path.exists(api_responses_folder):
-        os.makedirs(api_responses_folder) 
+    if check.lower() != "y":
+        print("Python script terminated by user.")
+        sys.exit()   
 
-    # Initialize error counter for api calls
-    error_count = 0
-    
-    # API rate limit and number of workers
-    MAX_REQUESTS_PER_MINUTE = 80
-    MAX_WORKERS = 1  # Number of threads in the ThreadPoolExecutor
-
-    # Loop through all image files until no error appears (or if the user desires to procede)
-    while len(files) != 0:
-
-        # Check with user to make all the API Calls
-        user_check(f"There will be made {len(files)} api calls with {MAX_TOKENS_PER_API_CALL} max_tokens each.\nWrite y to procede: ")
-
-        # Use ThreadPoolExecutor to make requests in parallel
-        with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-            api_response = {executor.submit(gpt_request, image_file): image_file for image_file in files}
-            for future in concurrent.futures.as_completed(api_response):
-
-                image_file = api_response[future]
-
-                try:
-                    # Define file names
-                    file_name = os.path.basename(image_file)
-                    file_name_without_extension, _ = os.path.splitext(file_name)
-
-                    # Define response and data from the gpt_request response
-                    response = future.result()
-                    data = response.json()
-                    
-                    # Handle Error in response
-                    if "error" in data:
-                        # Print Error Code
-                        error_code = data["error"]["code"]
-                        print(f"Error code: {error_code}\n")
-
-                        # Define response message string
-                        response_message = data["error"]["message"]
-
-                        if error_code == "rate_limit_exceeded":
-                            # Regular expression to extract the time
-                            match = re.search(r'Please try again in ([\d.]+)s', response_message)
-
-                            # Extracted time in seconds
-                            wait_time = float(match.group(1)) if match else None
-
-                            # Round it
-                            rounded_wait_time = int(wait_time) + 1
-
-                            # Pause workers
-                            time.sleep(rounded_wait_time)
-
-                    # Save response for registering (and possible check of errors)
-                    file_path = os.path.join(api_responses_folder, file_name_without_extension) + "_resp.json"
-                    with open(file_path, 'w') as file:
-                        json.dump(data, file, indent=4)
-
-                    # Save the data as a JSON file
-                    save_data_as_json(file_name_without_extension, data)
-                        
-
-                    # Pop out the completed file from files list
-                    files.remove(image_file)
-                except Exception as e:
-                    print(f"\nThe following Exception occurred on the file: {image_file}\n  ")
-                    print(e)
-                    print('\n')
-                    
-                    error_count += 1
-
-        if error_count != 0:
-            print(f"\n\nThere were {error_count} errors in the API calls. For them, you may want to try again.\n")
-            # Reinitialize error counter
-            error_count = 0
-
-            # Alert error
-            os.system("""
-            osascript -e 'display notification "An Error was encountered. Check the terminal to procede." with title "Python Script Notification"'
-            """)
+def main():
+
+    parser = argparse.ArgumentParser(description="Solve the questions in output_0_areas with the OpenAI API.")
+    parser.add_argument("--async", dest="use_async", action="store_true", help="use the asyncio pipeline with one pooled HTTP session instead of threads")
+    parser.add_argument("--batch", action="store_true", help="send all the requests in one batch job and wait for its results")
+    parser.add_argument("--pack", action="store_true", help="send several question images in each request")
+    parser.add_argument("--max-in-flight", type=int, default=None, help="maximum concurrent requests in the asyncio pipeline")
+    parser.add_argument("--stream", action="store_true", help="receive the answers as a stream, saving each 'enunciado' as soon as it arrives")
+    parser.add_argument("--no-cache", action="store_true", help="always call the API, even for images that were already solved")
+    parser.add_argument("--dedup", action="store_true", help="reuse the answer of an already solved question for crops that look the same")
+    parser.add_argument("--retry-failed", action="store_true", help="also retry the images that already failed MAX_RETRIES times")
+    parser.add_argument("--yes", action="store_true", help="do not ask for confirmation (for unattended runs)")
+    args = parser.parse_args()
+
+    # Only the threaded requests can be streamed
+    modes = [flag for flag, used in (("--async", args.use_async), ("--batch", args.batch), ("--pack", args.pack)) if used]
+    if len(modes) > 1:
+        parser.error(f"{' and '.join(modes)} can't be used together")
+    if args.stream and modes:
+        parser.error(f"--stream can't be used with {modes[0]}")
+
+    global USE_CACHE, USE_STREAM, USE_DEDUP
+    USE_CACHE = USE_CACHE and not args.no_cache
+    USE_STREAM = USE_STREAM or args.stream
+    USE_DEDUP = USE_DEDUP or args.dedup
+
+    if USE_STREAM and modes:
+        print(f"USE_STREAM is ignored with {modes[0]}: the answers are received whole.")
+        USE_STREAM = False
+
+    # Path to your images
+    images_path = "output_0_areas"
+
+    # Resume from the journal: images solved in an earlier run are skipped
+    metrics = get_shared_metrics()
+    journal = JobJournal(JOURNAL_PATH, listener=metrics.journal_record)
+    files = journal.files_to_process(list_image_files(images_path), retry_failed=args.retry_failed)
+
+    # Questions already solved in this or another exam are not paid again, nor the repeated ones of this exam
+    rounds = [files]
+    if USE_DEDUP:
+        files = solve_from_duplicates(files, journal)
+        rounds = duplicate_rounds(files)
+
+    if len(files) == 0:
+        print("All images were already solved.")
+        return
+
+    # Check with user to make all the API Calls
+    if not args.yes:
+        repeated = f" (and up to {len(rounds[1])} for the crops that look like another one)" if len(rounds) > 1 and rounds[1] else ""
+        user_check(f"There will be made {len(rounds[0])} api calls{repeated} with {MAX_TOKENS_PER_API_CALL} max_tokens each.\nWrite y to procede: ")
+
+    # Timing, tokens and progress of the run (see p2_metrics.py)
+    metrics.start(len(files))
+
+    failed_files = []
+    for i, round_files in enumerate(rounds):
+        # The repeated crops whose first one was solved are answered without a request
+        if i > 0:
+            round_files = solve_from_duplicates(round_files, journal)
+        if not round_files:
+            continue
+
+        if args.batch:
+            from p2_batch import run_batch
+            failed_files += run_batch(round_files, journal)
+        elif args.pack:
+            from p2_packing import run_packed
+            failed_files += run_packed(round_files, journal)
+        elif args.use_async:
+            from p2_async import run_async
+            failed_files += run_async(round_files, journal, args.max_in_flight)
+        else:
+            failed_files += run_threaded(round_files, journal)
+
+    journal.close()
+    metrics.close()
+    print(f"\nJournal: {journal.summary()}")
+
+    print_summary(metrics.export())
+    print(f"Metrics saved in {METRICS_JSON_PATH} and {METRICS_CSV_PATH}")
+
+    if len(failed_files) != 0:
+        print(f"\n\nThere were {len(failed_files)} images that failed {MAX_RETRIES} times. Run again with --retry-failed to try them again.\n")
+
+        # Alert error
+        os.system("""
+        osascript -e 'display notification "An Error was encountered. Check the terminal to procede." with title "Python Script Notification"'
+        """)
+
+    if USE_CACHE:
+        get_shared_cache().report()
 
     # Script ends here
     os.system("""
             osascript -e 'display notification "Script has finished running." with title "Python Script Notification"'
             """)
+
+if __name__ == "__main__":
+    # Run through the importable module, so that the other p2 modules share the same settings
+    import p2_main
+    p2_main.main()
@@ -0,0 +1,204 @@
+import csv
+import json
+import os
+import re
+import threading
+import time
+
+import numpy as np
+from tqdm import tqdm
+
+import p0_configuration as configuration
+from p2_journal import DONE, FAILED, IN_FLIGHT, MAX_RETRIES
+
+# Prices per 1K tokens, to estimate the spend of a run (gpt-4-vision-preview by default)
+PRICE_PER_1K_PROMPT_TOKENS = getattr(configuration, "PRICE_PER_1K_PROMPT_TOKENS", 0.01)
+PRICE_PER_1K_COMPLETION_TOKENS = getattr(configuration, "PRICE_PER_1K_COMPLETION_TOKENS", 0.03)
+
+# (prompt, completion) prices per 1K tokens of each model, e.g. {"gpt-4o-mini": (0.00015, 0.0006)} for the tiers of
+# MODEL_TIERS. The models not listed cost the prices above
+MODEL_PRICES = getattr(configuration, "MODEL_PRICES", {})
+
+# Show a progress bar with the ETA while the images are solved
+SHOW_PROGRESS = getattr(configuration, "SHOW_PROGRESS", True)
+
+# Summary of the run and one line per API call
+METRICS_JSON_PATH = os.path.join("api_responses", "metrics.json")
+METRICS_CSV_PATH = os.path.join("api_responses", "metrics.csv")
+
+# Page of the crops saved by p1_prepare_inputs.py
+PAGE_NAME = re.compile(r'output_page_(\d+)_area_')
+
+REQUEST_FIELDS = ["time", "kind", "model", "images", "status_code", "encode_seconds", "queue_seconds", "latency_seconds",
+                  "time_to_first_token", "bytes_uploaded", "prompt_tokens", "completion_tokens"]
+
+
+def request_cost(prompt_tokens, completion_tokens, model=None):
+    prompt_price, completion_price = MODEL_PRICES.get(model, (PRICE_PER_1K_PROMPT_TOKENS, PRICE_PER_1K_COMPLETION_TOKENS))
+    return prompt_tokens / 1000 * prompt_price + completion_tokens / 1000 * completion_price
+
+
+def page_of(image):
+    match = PAGE_NAME.search(image)
+    return int(match.group(1)) if match else None
+
+
+def percentile(values, q):
+    return round(float(np.percentile(values, q)), 3) if values else None
+
+
+def mean(values):
+    return round(float(np.mean(values)), 3) if values else None
+
+
+class RunMetrics:
+    """Timing and token usage of every API call of a run, with a progress bar fed by the journal."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = []
+        self.attempts = {}
+        self.finished = {}
+        self.start_time = time.perf_counter()
+        self.progress = None
+
+    def start(self, total):
+        self.start_time = time.perf_counter()
+        if SHOW_PROGRESS:
+            self.progress = tqdm(total=total, unit="image", desc="Solving")
+
+    def record_request(self, images, kind, data=None, status_code=None, encode_seconds=None, queue_seconds=None,
+                       latency_seconds=None, bytes_uploaded=None, model=None):
+        """Keep one API call: the images (names) it was about, the model, how long each step took and the tokens it used."""
+        usage = (data or {}).get("usage") or {}
+        timing = (data or {}).get("stream_timing") or {}
+        row = {
+            "time": time.time(),
+            "kind": kind,
+            "model": model or (data or {}).get("model"),
+            "images": list(images),
+            "status_code": status_code,
+            "encode_seconds": encode_seconds,
+            "queue_seconds": queue_seconds,
+            "latency_seconds": latency_seconds,
+            "time_to_first_token": timing.get("time_to_first_token"),
+            "bytes_uploaded": bytes_uploaded,
+            "prompt_tokens": usage.get("prompt_tokens", 0),
+            "completion_tokens": usage.get("completion_tokens", 0)
+        }
+        with self.lock:
+            self.requests.append(row)
+
+    def journal_record(self, image_file, state, attempts):
+        """Listener of the journal: count the attempts and move the progress bar when an image is finished."""
+        with self.lock:
+            if state == IN_FLIGHT:
+                self.attempts[image_file] = self.attempts.get(image_file, 0) + 1
+            finished = state == DONE or (state == FAILED and attempts >= MAX_RETRIES)
+            if not finished or image_file in self.finished:
+                return
+            self.finished[image_file] = state
+
+        if self.progress is not None:
+            self.progress.update(1)
+
+    def close(self):
+        if self.progress is not None:
+            self.progress.close()
+
+    def summary(self):
+        with self.lock:
+            requests = list(self.requests)
+            finished = dict(self.finished)
+            attempts = dict(self.attempts)
+        wall_seconds = time.perf_counter() - self.start_time
+
+        done = sum(1 for state in finished.values() if state == DONE)
+        prompt_tokens = sum(row["prompt_tokens"] for row in requests)
+        completion_tokens = sum(row["completion_tokens"] for row in requests)
+
+        # Each request is priced with its model. The tokens of a packed request are shared evenly by its images
+        total_cost = 0
+        cost_per_page = {}
+        tokens_per_image = {}
+        for row in requests:
+            request_total = request_cost(row["prompt_tokens"], row["completion_tokens"], row["model"])
+            total_cost += request_total
+            cost = request_total / max(1, len(row["images"]))
+            for image in row["images"]:
+                page = page_of(image)
+                cost_per_page[page] = cost_per_page.get(page, 0) + cost
+                tokens_per_image[image] = tokens_per_image.get(image, 0) + (row["prompt_tokens"] + row["completion_tokens"]) / len(row["images"])
+
+        requests_per_model = {}
+        for row in requests:
+            requests_per_model[row["model"]] = requests_per_model.get(row["model"], 0) + 1
+
+        latencies = [row["latency_seconds"] for row in requests if row["latency_seconds"] is not None]
+        slowest = sorted((row for row in requests if row["latency_seconds"] is not None), key=lambda row: row["latency_seconds"], reverse=True)[:5]
+
+        return {
+            "images_finished": len(finished),
+            "images_done": done,
+            "images_failed": len(finished) - done,
+            "wall_seconds": round(wall_seconds, 3),
+            "questions_per_minute": round(done / wall_seconds * 60, 2) if wall_seconds else None,
+            "requests": len(requests),
+            "requests_per_model": {str(model): count for model, count in requests_per_model.items()},
+            "retries": sum(max(0, count - 1) for count in attempts.values()),
+            "bytes_uploaded": sum(row["bytes_uploaded"] or 0 for row in requests),
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "tokens_per_question": round((prompt_tokens + completion_tokens) / done, 1) if done else None,
+            "cost_usd": round(total_cost, 4),
+            "cost_per_page_usd": {str(page): round(cost, 4) for page, cost in sorted(cost_per_page.items(), key=lambda item: (item[0] is None, item[0] or 0))},
+            "latency_p50": percentile(latencies, 50),
+            "latency_p95": percentile(latencies, 95),
+            "encode_mean_seconds": mean([row["encode_seconds"] for row in requests if row["encode_seconds"] is not None]),
+            "queue_mean_seconds": mean([row["queue_seconds"] for row in requests if row["queue_seconds"] is not None]),
+            "slowest_requests": [{"images": row["images"], "latency_seconds": round(row["latency_seconds"], 3)} for row in slowest],
+            "most_tokens": [{"image": image, "tokens": round(tokens)} for image, tokens in sorted(tokens_per_image.items(), key=lambda item: item[1], reverse=True)[:5]]
+        }
+
+    def export(self, json_path=METRICS_JSON_PATH, csv_path=METRICS_CSV_PATH):
+        """Write the summary as JSON and one line per API call as CSV. Return the summary."""
+        summary = self.summary()
+        with open(json_path, 'w') as file:
+            json.dump(summary, file, indent=4)
+
+        with self.lock:
+            requests = list(self.requests)
+        with open(csv_path, 'w', newline='') as file:
+            writer = csv.DictWriter(file, fieldnames=REQUEST_FIELDS)
+            writer.writeheader()
+            for row in requests:
+                writer.writerow(dict(row, images=";".join(row["images"])))
+        return summary
+
+
+def print_summary(summary):
+    print("\nRun summary:")
+    print(f"  {summary['images_done']} questions solved, {summary['images_failed']} failed, in {summary['wall_seconds']:.1f}s"
+          f" ({summary['questions_per_minute']} per minute)")
+    print(f"  {summary['requests']} requests, {summary['retries']} retries, {summary['bytes_uploaded'] / 1e6:.1f} MB uploaded")
+    if len(summary["requests_per_model"]) > 1:
+        print("  Requests per model: " + ", ".join(f"{model} {count}" for model, count in summary["requests_per_model"].items()))
+    print(f"  {summary['prompt_tokens']} prompt + {summary['completion_tokens']} completion tokens"
+          f" ({summary['tokens_per_question']} per question), about ${summary['cost_usd']:.2f}")
+    if summary["latency_p50"] is not None:
+        print(f"  Latency p50 {summary['latency_p50']}s, p95 {summary['latency_p95']}s")
+    for row in summary["slowest_requests"][:3]:
+        print(f"  Slow request: {';'.join(row['images'])} ({row['latency_seconds']}s)")
+
+
+# Metrics shared by every request of the process
+shared_metrics = None
+shared_metrics_lock = threading.Lock()
+
+
+def get_shared_metrics():
+    global shared_metrics
+    with shared_metrics_lock:
+        if shared_metrics is None:
+            shared_metrics = RunMetrics()
+        return shared_metrics
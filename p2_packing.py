@@ -0,0 +1,174 @@
+import concurrent.futures
+import json
+import time
+
+import p0_configuration as configuration
+from p0_configuration import MAX_TOKENS_PER_API_CALL
+from p0_assistant_instructions import assistant_instructions, packed_instructions
+from p2_image_optimizer import IMAGE_DETAIL
+from p2_journal import DONE, FAILED, IN_FLIGHT, MAX_RETRIES, PENDING, backoff_delay
+from p2_main import (MAX_WORKERS, MODEL, REASK_INVALID_ANSWERS, APIError, encode_image, image_name, parse_content, post_completion,
+                     reask_for_json, remember_question, report_exception, save_api_response, solve_from_cache, solve_from_duplicate,
+                     solve_with_retries, store_in_cache, write_question_json)
+from p2_rate_limiter import get_shared_limiter
+from p2_schema import InvalidAnswer, parse_question, question_errors
+
+# Maximum number of question images sent in one request
+PACK_SIZE = getattr(configuration, "PACK_SIZE", 4)
+
+# Output tokens expected for each question, used to keep the packs under MAX_TOKENS_PER_API_CALL
+TOKENS_PER_PACKED_QUESTION = getattr(configuration, "TOKENS_PER_PACKED_QUESTION", 800)
+
+
+class PackError(Exception):
+    """The answer of a pack could not be matched with its images."""
+
+
+def make_packs(files):
+    """Split the files into packs whose answers fit in MAX_TOKENS_PER_API_CALL."""
+    pack_size = max(1, min(PACK_SIZE, MAX_TOKENS_PER_API_CALL // TOKENS_PER_PACKED_QUESTION))
+    return [files[i:i + pack_size] for i in range(0, len(files), pack_size)]
+
+
+def build_packed_payload(encoded_images):
+    content = [{
+        "type": "text",
+        "text": assistant_instructions + packed_instructions + f"\nNúmero de imagens: {len(encoded_images)}"
+    }]
+    for base64_image, mime_type in encoded_images:
+        content.append({
+            "type": "image_url",
+            "image_url": {"url": f"data:{mime_type};base64,{base64_image}", "detail": IMAGE_DETAIL}
+        })
+
+    return {"model": MODEL, "messages": [{"role": "user", "content": content}], "max_tokens": MAX_TOKENS_PER_API_CALL}
+
+
+def packed_request(image_files):
+    """Same as gpt_request, sending all the images of the pack in one chat request."""
+    print(f"Making request for OpenAI API with {len(image_files)} images...")
+
+    start_time = time.perf_counter()
+    encoded_images = []
+    image_tokens = 0
+    for image_file in image_files:
+        base64_image, mime_type, tokens = encode_image(image_file)
+        encoded_images.append((base64_image, mime_type))
+        image_tokens += tokens
+    payload = build_packed_payload(encoded_images)
+    encode_seconds = time.perf_counter() - start_time
+
+    return post_completion(payload, get_shared_limiter(), MODEL, "pack", [image_name(image_file) for image_file in image_files],
+                           image_tokens, encode_seconds)
+
+
+def split_packed_answer(data, image_files):
+    """Return one question JSON per image of the pack."""
+    count = len(image_files)
+    if "error" in data:
+        raise APIError(f"{data['error'].get('code')}: {data['error'].get('message')}")
+
+    if data['choices'][0].get('finish_reason') == 'length':
+        raise PackError("The answer of the pack was cut off at max_tokens")
+
+    try:
+        questions = parse_content(data['choices'][0]['message']['content'])
+    except (InvalidAnswer, KeyError, IndexError) as e:
+        raise PackError(f"Answer is not valid JSON: {e}")
+
+    if not isinstance(questions, list) or len(questions) != count:
+        received = len(questions) if isinstance(questions, list) else type(questions).__name__
+        raise PackError(f"Expected a JSON array with {count} questions, received {received}")
+
+    # A question in the wrong format is sent back alone to be corrected, instead of sending the images again
+    for i, question in enumerate(questions):
+        errors = question_errors(question)
+        if not errors:
+            continue
+        if not REASK_INVALID_ANSWERS:
+            raise PackError(f"Question {i + 1} of the pack is invalid: {'; '.join(errors)}")
+
+        print(f"Invalid question {i + 1} in pack ({'; '.join(errors)}), asking for a correction without the image...")
+        try:
+            questions[i] = parse_question(reask_for_json(json.dumps(question, ensure_ascii=False), errors, [image_name(image_files[i])]))
+        except InvalidAnswer as e:
+            raise PackError(f"Question {i + 1} of the pack is still invalid: {e}")
+
+    return questions
+
+
+def solve_pack(image_files, journal):
+    """Solve a pack of images, recording failures in the journal. Packs whose answer can't be matched with the images are split in two and tried again."""
+
+    # Images answered meanwhile from the index of duplicates leave the pack
+    image_files = [image_file for image_file in image_files if not solve_from_duplicate(image_file, journal)]
+    if not image_files:
+        return
+
+    # A single image is solved as usual
+    if len(image_files) == 1:
+        try:
+            solve_with_retries(image_files[0], journal)
+        except Exception:
+            # Already reported and recorded as failed
+            pass
+        return
+
+    while True:
+        for image_file in image_files:
+            journal.record(image_file, IN_FLIGHT)
+
+        try:
+            data = packed_request(image_files)
+            questions = split_packed_answer(data, image_files)
+        except PackError as e:
+            print(f"Splitting pack of {len(image_files)} images: {e}")
+            for image_file in image_files:
+                journal.record(image_file, FAILED, error=e)
+                # The smaller packs get their own retry count
+                journal.record(image_file, PENDING)
+            half = len(image_files) // 2
+            solve_pack(image_files[:half], journal)
+            solve_pack(image_files[half:], journal)
+            return
+        except Exception as e:
+            for image_file in image_files:
+                report_exception(image_file, e)
+                journal.record(image_file, FAILED, error=e)
+
+            attempts = journal.attempts(image_files[0])
+            if attempts >= MAX_RETRIES:
+                return
+            delay = backoff_delay(attempts)
+            print(f"Retrying pack of {len(image_files)} images in {delay:.1f}s (attempt {attempts + 1} of {MAX_RETRIES})")
+            time.sleep(delay)
+            continue
+
+        for image_file, question in zip(image_files, questions):
+            print(f"Saving data as JSON: image {image_name(image_file)}")
+            save_api_response(image_file, data)
+            write_question_json(image_name(image_file), question)
+
+            # Cache each question as if it had been a request of its own
+            store_in_cache(image_file, {"choices": [{"message": {"role": "assistant", "content": json.dumps(question, ensure_ascii=False)}}]})
+            remember_question(image_file)
+            journal.record(image_file, DONE)
+        return
+
+
+def run_packed(files, journal):
+    """Make the API calls with several images per request. Return the files that failed."""
+    failed_files = []
+
+    # Images already solved are answered from the cache, without entering a pack
+    remaining = solve_from_cache(files, journal)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        futures = [executor.submit(solve_pack, pack, journal) for pack in make_packs(remaining)]
+        concurrent.futures.wait(futures)
+
+    for image_file in remaining:
+        if journal.state(image_file) != DONE:
+            failed_files.append(image_file)
+
+    return failed_files
@@ -0,0 +1,264 @@
+import asyncio
+import os
+import re
+import threading
+import time
+from multiprocessing.managers import BaseManager
+
+import p0_configuration as configuration
+
+# Default OpenAI API quota (can be overwritten in p0_configuration.py)
+MAX_REQUESTS_PER_MINUTE = getattr(configuration, "MAX_REQUESTS_PER_MINUTE", 80)
+MAX_TOKENS_PER_MINUTE = getattr(configuration, "MAX_TOKENS_PER_MINUTE", 30000)
+
+# Rate budget shared by the exams of scheduler.py, given to each of its jobs in the environment
+RATE_BUDGET_ADDRESS = os.environ.get("RATE_BUDGET_ADDRESS")
+RATE_BUDGET_AUTHKEY = os.environ.get("RATE_BUDGET_AUTHKEY", "")
+RATE_BUDGET_JOB = os.environ.get("RATE_BUDGET_JOB", str(os.getpid()))
+
+# Methods of the shared rate budget that the jobs can call
+RATE_BUDGET_METHODS = ("reserve", "refund", "pause", "update_from_headers")
+
+# Headers read by update_from_headers, the only ones sent to the shared rate budget
+RATE_LIMIT_HEADERS = ("x-ratelimit-limit-requests", "x-ratelimit-limit-tokens", "x-ratelimit-remaining-requests",
+                      "x-ratelimit-remaining-tokens", "x-ratelimit-reset-requests", "x-ratelimit-reset-tokens")
+
+# Seconds a job waiting for its turn asks again, and keeps its place after a refused request
+TURN_DELAY = 0.05
+TURN_GRACE = 1.0
+
+
+def parse_reset_time(value):
+    """Convert a reset header value such as '1s', '6m0s' or '20ms' into seconds."""
+    if value is None:
+        return None
+
+    seconds = 0.0
+    units = {"h": 3600, "m": 60, "s": 1, "ms": 0.001}
+    matches = re.findall(r'([\d.]+)(ms|h|m|s)', str(value))
+    if not matches:
+        return None
+
+    for amount, unit in matches:
+        seconds += float(amount) * units[unit]
+
+    return seconds
+
+
+class RateLimiter:
+    """Token bucket shared by all workers, limiting both requests and tokens per minute."""
+
+    def __init__(self, requests_per_minute, tokens_per_minute):
+        self.lock = threading.Lock()
+        self.request_capacity = float(requests_per_minute)
+        self.token_capacity = float(tokens_per_minute)
+        self.available_requests = self.request_capacity
+        self.available_tokens = self.token_capacity
+        self.blocked_until = 0.0
+        self.last_refill = time.monotonic()
+
+    def _refill(self, now):
+        # Both buckets refill continuously, reaching full capacity after one minute
+        elapsed = now - self.last_refill
+        self.last_refill = now
+        self.available_requests = min(self.request_capacity, self.available_requests + elapsed * self.request_capacity / 60)
+        self.available_tokens = min(self.token_capacity, self.available_tokens + elapsed * self.token_capacity / 60)
+
+    def reserve(self, tokens):
+        """Try to take one request and the given tokens. Return 0 on success, or the seconds to wait before trying again."""
+
+        # A single call can never ask for more than the whole bucket
+        tokens = min(tokens, self.token_capacity)
+
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+
+            if now < self.blocked_until:
+                return self.blocked_until - now
+
+            missing_requests = 1 - self.available_requests
+            missing_tokens = tokens - self.available_tokens
+
+            if missing_requests <= 0 and missing_tokens <= 0:
+                self.available_requests -= 1
+                self.available_tokens -= tokens
+                return 0
+
+            return max(missing_requests * 60 / self.request_capacity, missing_tokens * 60 / self.token_capacity)
+
+    def acquire(self, tokens):
+        """Block until the request fits the budget. Return the total time waited."""
+        waited = 0.0
+        while True:
+            delay = self.reserve(tokens)
+            if delay == 0:
+                return waited
+            time.sleep(delay)
+            waited += delay
+
+    async def acquire_async(self, tokens):
+        """Same as acquire, but waiting without blocking the event loop."""
+        waited = 0.0
+        while True:
+            delay = self.reserve(tokens)
+            if delay == 0:
+                return waited
+            await asyncio.sleep(delay)
+            waited += delay
+
+    def refund(self, tokens):
+        """Give back tokens that were reserved but not used (or take more if the estimate was too low)."""
+        with self.lock:
+            self.available_tokens = min(self.token_capacity, self.available_tokens + tokens)
+
+    def pause(self, seconds):
+        """Stop every worker from sending requests for the given time."""
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    def update_from_headers(self, headers):
+        """Adjust the budget with the x-ratelimit-* headers of an API response."""
+
+        def header_number(name):
+            value = headers.get(name)
+            try:
+                return float(value) if value is not None else None
+            except ValueError:
+                return None
+
+        limit_requests = header_number("x-ratelimit-limit-requests")
+        limit_tokens = header_number("x-ratelimit-limit-tokens")
+        remaining_requests = header_number("x-ratelimit-remaining-requests")
+        remaining_tokens = header_number("x-ratelimit-remaining-tokens")
+        reset_requests = parse_reset_time(headers.get("x-ratelimit-reset-requests"))
+        reset_tokens = parse_reset_time(headers.get("x-ratelimit-reset-tokens"))
+
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+
+            # The server knows the real quota of the account
+            if limit_requests:
+                self.request_capacity = limit_requests
+            if limit_tokens:
+                self.token_capacity = limit_tokens
+
+            # Trust whichever count is more conservative
+            if remaining_requests is not None:
+                self.available_requests = min(self.available_requests, remaining_requests)
+            if remaining_tokens is not None:
+                self.available_tokens = min(self.available_tokens, remaining_tokens)
+
+            # Nothing left: hold everyone until the server resets the quota
+            if remaining_requests == 0 and reset_requests:
+                self.blocked_until = max(self.blocked_until, now + reset_requests)
+            if remaining_tokens == 0 and reset_tokens:
+                self.blocked_until = max(self.blocked_until, now + reset_tokens)
+
+
+class FairRateBudget(RateLimiter):
+    """RateLimiter shared by several jobs, giving the budget in turns to the jobs that are waiting for it.
+
+    Each job counts the tokens it was given. While the budget is short, a job only gets it when no other waiting job was
+    given fewer tokens, so a large exam can't hold back the small ones that start after it.
+    """
+
+    def __init__(self, requests_per_minute, tokens_per_minute):
+        super().__init__(requests_per_minute, tokens_per_minute)
+        self.fair_lock = threading.Lock()
+        self.served = {}    # tokens given to each job
+        self.waiting = {}   # jobs refused, until when they are expected to ask again
+
+    def reserve(self, tokens, job=None):
+        with self.fair_lock:
+            now = time.monotonic()
+            self.waiting = {name: until for name, until in self.waiting.items() if until > now}
+
+            if job not in self.served:
+                # A new job starts level with the jobs already waiting, instead of owing them everything they were given
+                self.served[job] = min((self.served[name] for name in self.waiting), default=0)
+
+            if any(self.served[name] < self.served[job] for name in self.waiting if name != job):
+                self.waiting[job] = now + TURN_DELAY + TURN_GRACE
+                return TURN_DELAY
+
+            delay = super().reserve(tokens)
+            if delay:
+                self.waiting[job] = now + delay + TURN_GRACE
+            else:
+                self.waiting.pop(job, None)
+                self.served[job] += min(tokens, self.token_capacity)
+            return delay
+
+
+class RateBudgetManager(BaseManager):
+    """Connection between the jobs and the FairRateBudget of scheduler.py."""
+
+
+RateBudgetManager.register("rate_budget", exposed=RATE_BUDGET_METHODS)
+
+
+def serve_rate_budgets(authkey):
+    """Serve one FairRateBudget per name (e.g. per model) to other processes, from a thread of this one.
+    Return the address ("host:port") to connect to."""
+    budgets = {}
+    budgets_lock = threading.Lock()
+
+    def rate_budget(name=None, requests_per_minute=MAX_REQUESTS_PER_MINUTE, tokens_per_minute=MAX_TOKENS_PER_MINUTE):
+        with budgets_lock:
+            if name not in budgets:
+                budgets[name] = FairRateBudget(requests_per_minute, tokens_per_minute)
+            return budgets[name]
+
+    class BudgetServer(RateBudgetManager):
+        pass
+
+    BudgetServer.register("rate_budget", callable=rate_budget, exposed=RATE_BUDGET_METHODS)
+    server = BudgetServer(address=("127.0.0.1", 0), authkey=authkey).get_server()
+    threading.Thread(target=server.serve_forever, name="rate-budget", daemon=True).start()
+    return f"{server.address[0]}:{server.address[1]}"
+
+
+class RemoteRateLimiter(RateLimiter):
+    """RateLimiter of a job of scheduler.py: every call is made on the budget shared by all the jobs."""
+
+    def __init__(self, address, authkey, job, name=None, requests_per_minute=MAX_REQUESTS_PER_MINUTE, tokens_per_minute=MAX_TOKENS_PER_MINUTE):
+        host, port = address.rsplit(":", 1)
+        manager = RateBudgetManager(address=(host, int(port)), authkey=authkey)
+        manager.connect()
+        self.budget = manager.rate_budget(name, requests_per_minute, tokens_per_minute)
+        self.job = job
+
+    def reserve(self, tokens):
+        return self.budget.reserve(tokens, self.job)
+
+    def refund(self, tokens):
+        self.budget.refund(tokens)
+
+    def pause(self, seconds):
+        self.budget.pause(seconds)
+
+    def update_from_headers(self, headers):
+        self.budget.update_from_headers({name: headers.get(name) for name in RATE_LIMIT_HEADERS})
+
+
+_shared_limiters = {}
+_shared_limiter_lock = threading.Lock()
+
+
+def get_shared_limiter(name=None, requests_per_minute=None, tokens_per_minute=None):
+    """Return the process-wide rate limiter of the given name (one per model with tiers, see p2_routing.py) used by every API call.
+
+    The quota is only used when the limiter is created, and defaults to MAX_REQUESTS_PER_MINUTE and MAX_TOKENS_PER_MINUTE.
+    """
+    requests_per_minute = requests_per_minute or MAX_REQUESTS_PER_MINUTE
+    tokens_per_minute = tokens_per_minute or MAX_TOKENS_PER_MINUTE
+    with _shared_limiter_lock:
+        if name not in _shared_limiters and RATE_BUDGET_ADDRESS:
+            # Run by scheduler.py: the quota is shared with the other exams
+            _shared_limiters[name] = RemoteRateLimiter(RATE_BUDGET_ADDRESS, bytes.fromhex(RATE_BUDGET_AUTHKEY), RATE_BUDGET_JOB,
+                                                       name, requests_per_minute, tokens_per_minute)
+        elif name not in _shared_limiters:
+            _shared_limiters[name] = RateLimiter(requests_per_minute, tokens_per_minute)
+        return _shared_limiters[name]
@@ -0,0 +1,72 @@
+from PIL import Image
+
+import p0_configuration as configuration
+from p2_rate_limiter import get_shared_limiter
+from p2_schema import InvalidAnswer, parse_question
+
+# Model used to solve the questions (and for --pack, --batch and the corrections of invalid answers)
+MODEL = getattr(configuration, "MODEL", "gpt-4-vision-preview")
+
+# Models tried for each question, cheapest first, e.g.
+#   [{"model": "gpt-4o-mini", "requests_per_minute": 500, "tokens_per_minute": 200000}, {"model": "gpt-4o"}]
+# The answer of a tier is only replaced by the next one when it can't be used. Each model has a rate budget of its own
+# (MAX_REQUESTS_PER_MINUTE and MAX_TOKENS_PER_MINUTE unless given). Without it, every question goes to MODEL
+MODEL_TIERS = getattr(configuration, "MODEL_TIERS", None) or [{"model": MODEL}]
+
+# Also send the "Discursiva" questions answered by a lower tier to the next one
+ESCALATE_DISCURSIVA = getattr(configuration, "ESCALATE_DISCURSIVA", False)
+
+# Crops this many times taller than wide (long statements) go straight to the last tier (None to disable)
+LONG_CROP_RATIO = getattr(configuration, "LONG_CROP_RATIO", 1.5)
+
+
+def tier_limiter(tier):
+    """The rate budget of the model of a tier (the one of MODEL is the default budget)."""
+    if tier["model"] == MODEL and not ("requests_per_minute" in tier or "tokens_per_minute" in tier):
+        return get_shared_limiter()
+    return get_shared_limiter(tier["model"], tier.get("requests_per_minute"), tier.get("tokens_per_minute"))
+
+
+def tiers_for(image_path, reached=None):
+    """The tiers to try for an image, in order, starting from the one of the model reached by its earlier attempts."""
+    tiers = MODEL_TIERS
+    if LONG_CROP_RATIO is not None and len(tiers) > 1:
+        with Image.open(image_path) as image:
+            width, height = image.size
+        if height > width * LONG_CROP_RATIO:
+            tiers = tiers[-1:]
+
+    models = [tier["model"] for tier in tiers]
+    if reached in models:
+        return tiers[models.index(reached):]
+    return tiers
+
+
+def escalation_reason(data):
+    """Why the answer of a lower tier should be asked to the next one, or None if it can be used.
+
+    Errors of the API are not a reason: they are retried on the same tier.
+    """
+    if "error" in data:
+        return None
+
+    choice = data["choices"][0]
+    if choice.get("finish_reason") == "length":
+        return "cut off at max_tokens"
+
+    try:
+        question = parse_question(choice["message"]["content"])
+    except InvalidAnswer as e:
+        return f"invalid answer ({e})"
+
+    if ESCALATE_DISCURSIVA and question["tipo"] == "Discursiva":
+        return "Discursiva"
+    return None
+
+
+def routing_fingerprint():
+    """What decides the model of an answer, for the cache key (only the model when there are no tiers)."""
+    if len(MODEL_TIERS) == 1:
+        return MODEL_TIERS[0]["model"]
+    models = "+".join(tier["model"] for tier in MODEL_TIERS)
+    return f"{models}|discursiva={ESCALATE_DISCURSIVA}|long={LONG_CROP_RATIO}"
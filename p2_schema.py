@@ -0,0 +1,189 @@
+import ast
+import json
+
+from p2_stream_parser import extract_json_text
+
+# JSON Schema of the question described in p0_assistant_instructions.py
+QUESTION_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "enunciado": {"type": "string"},
+        "tipo": {"type": "string", "enum": ["Discursiva", "Objetiva"]},
+        "resposta": {
+            "anyOf": [
+                # Discursiva: the answer as text
+                {"type": "string"},
+                # Objetiva: one object per alternative ("a", "b", ...) and the letter of the correct one
+                {
+                    "type": "object",
+                    "properties": {"alternativaCorreta": {"type": "string"}},
+                    "required": ["alternativaCorreta"],
+                    "additionalProperties": {
+                        "type": "object",
+                        "properties": {"alternativa": {"type": "string"}, "textoExplicativo": {"type": "string"}},
+                        "required": ["alternativa", "textoExplicativo"]
+                    }
+                }
+            ]
+        }
+    },
+    "required": ["enunciado", "tipo", "resposta"]
+}
+
+JSON_TYPES = {"object": dict, "array": list, "string": str, "number": (int, float), "boolean": bool, "null": type(None)}
+
+
+class InvalidAnswer(ValueError):
+    """The answer could not be read as a question in the expected format."""
+
+    def __init__(self, errors, text):
+        super().__init__("; ".join(errors))
+        self.errors = errors
+        self.text = text
+
+
+def schema_errors(value, schema, path="$"):
+    """Check the value against the subset of JSON Schema used in QUESTION_SCHEMA. Return the errors found."""
+    if "anyOf" in schema:
+        options = [schema_errors(value, option, path) for option in schema["anyOf"]]
+        if all(options):
+            # Report the option of the same type, or else the one that came closest
+            same_type = [errors for option, errors in zip(schema["anyOf"], options) if isinstance(value, JSON_TYPES[option["type"]])]
+            return min(same_type or options, key=len)
+        return []
+
+    expected_type = JSON_TYPES[schema["type"]]
+    if not isinstance(value, expected_type) or (schema["type"] == "number" and isinstance(value, bool)):
+        return [f"{path} should be of type {schema['type']}"]
+
+    if "enum" in schema and value not in schema["enum"]:
+        return [f"{path} should be one of {', '.join(map(json.dumps, schema['enum']))}"]
+
+    errors = []
+    if schema["type"] == "object":
+        properties = schema.get("properties", {})
+        for key in schema.get("required", []):
+            if key not in value:
+                errors.append(f"{path} is missing \"{key}\"")
+        for key, item in value.items():
+            if key in properties:
+                errors += schema_errors(item, properties[key], f"{path}.{key}")
+            elif isinstance(schema.get("additionalProperties"), dict):
+                errors += schema_errors(item, schema["additionalProperties"], f"{path}.{key}")
+    return errors
+
+
+def question_errors(question):
+    """Errors of a question: the schema, plus the rules between its fields."""
+    errors = schema_errors(question, QUESTION_SCHEMA)
+    if errors:
+        return errors
+
+    resposta = question["resposta"]
+    if question["tipo"] == "Discursiva" and not isinstance(resposta, str):
+        errors.append("$.resposta should be a string when \"tipo\" is \"Discursiva\"")
+    if question["tipo"] == "Objetiva":
+        if not isinstance(resposta, dict):
+            errors.append("$.resposta should be an object when \"tipo\" is \"Objetiva\"")
+        else:
+            alternatives = [key.lower() for key in resposta if key != "alternativaCorreta"]
+            if not alternatives:
+                errors.append("$.resposta has no alternatives")
+            elif resposta["alternativaCorreta"].strip(" )").lower() not in alternatives:
+                errors.append(f"$.resposta.alternativaCorreta \"{resposta['alternativaCorreta']}\" is not one of the alternatives")
+    return errors
+
+
+def remove_trailing_commas(text):
+    """Remove the commas right before a closing bracket, outside of strings."""
+    result = []
+    in_string = False
+    escape = False
+    for i, char in enumerate(text):
+        if in_string:
+            if escape:
+                escape = False
+            elif char == '\\':
+                escape = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char == ',' and text[i + 1:].lstrip()[:1] in ('}', ']'):
+            continue
+        result.append(char)
+    return ''.join(result)
+
+
+def python_literal(text):
+    """Read a Python-style literal (single quotes, True/False/None) as JSON would be read."""
+    result = []
+    quote = None
+    escape = False
+    i = 0
+    while i < len(text):
+        char = text[i]
+        if quote:
+            if escape:
+                escape = False
+            elif char == '\\':
+                escape = True
+            elif char == quote:
+                quote = None
+        elif char in '"\'':
+            quote = char
+        else:
+            # JSON literals outside of strings
+            for json_word, python_word in (("true", "True"), ("false", "False"), ("null", "None")):
+                if text.startswith(json_word, i) and not text[i + len(json_word):i + len(json_word) + 1].isalnum():
+                    result.append(python_word)
+                    i += len(json_word)
+                    break
+            else:
+                result.append(char)
+                i += 1
+            continue
+        result.append(char)
+        i += 1
+
+    value = ast.literal_eval(''.join(result))
+    if not isinstance(value, (dict, list)):
+        raise ValueError("not an object or array")
+    return value
+
+
+def repair_json(content):
+    """Read the JSON of a completion, repairing the usual mistakes: code fences, text around it, trailing commas and lenient quoting."""
+    # Valid JSON is read as it is: the repairs could only damage it
+    try:
+        return json.loads(content, strict=False)
+    except ValueError:
+        pass
+
+    text = extract_json_text(content)
+
+    attempts = [
+        lambda: json.loads(text, strict=False),
+        lambda: json.loads(remove_trailing_commas(text), strict=False),
+        lambda: python_literal(text),
+        # Typographic quotes used as JSON quotes
+        lambda: json.loads(remove_trailing_commas(text.replace('“', '"').replace('”', '"')), strict=False)
+    ]
+
+    first_error = None
+    for attempt in attempts:
+        try:
+            return attempt()
+        except (ValueError, SyntaxError, MemoryError, RecursionError) as e:
+            first_error = first_error or e
+    # The correction is asked with the whole answer, in case the extraction cut it
+    raise InvalidAnswer([f"not valid JSON: {first_error}"], content)
+
+
+def parse_question(content):
+    """Return the question of a completion, repaired if needed. Raise InvalidAnswer if it is not in the expected format."""
+    question = repair_json(content)
+    errors = question_errors(question)
+    if errors:
+        raise InvalidAnswer(errors, content)
+    return question
@@ -0,0 +1,101 @@
+import json
+import re
+
+
+def extract_json_text(content):
+    """Return the JSON part of a completion, without the ```json fences or any text around it."""
+    # Only a fence around the whole answer: one inside a string of the JSON is part of the question
+    match = re.match(r'^```(?:json)?\s*(.*?)\s*```$', content.strip(), re.DOTALL)
+    if match:
+        content = match.group(1)
+
+    # Keep from the first opening bracket to the last closing one
+    starts = [i for i in (content.find('{'), content.find('[')) if i != -1]
+    end = max(content.rfind('}'), content.rfind(']'))
+    if starts and end > min(starts):
+        content = content[min(starts):end + 1]
+
+    return content.strip()
+
+
+class IncrementalJSONParser:
+    """Follow a JSON document as it is streamed, reporting the top-level string fields as soon as they are complete.
+
+    Text before the first '{' or '[' (such as a ```json fence) is ignored.
+    """
+
+    def __init__(self, on_field=None):
+        self.on_field = on_field
+        self.text = []
+        self.depth = 0
+        self.started = False
+        self.complete = False
+        self.in_string = False
+        self.escape = False
+        self.string_chars = []
+        self.current_key = None
+        self.expecting = None   # "key" or "value" inside the top-level object
+        self.fields = {}
+
+    def feed(self, chunk):
+        """Parse the next piece of text. Return True once the top-level value is complete."""
+        for char in chunk:
+            if self.complete:
+                break
+            if not self.started:
+                if char not in '{[':
+                    continue
+                self.started = True
+            self.text.append(char)
+            self.parse_char(char)
+        return self.complete
+
+    def parse_char(self, char):
+        if self.in_string:
+            if self.escape:
+                self.escape = False
+            elif char == '\\':
+                self.escape = True
+            elif char == '"':
+                self.in_string = False
+                if self.depth == 1:
+                    self.end_top_level_string()
+                return
+            if self.depth == 1:
+                self.string_chars.append(char)
+            return
+
+        if char == '"':
+            self.in_string = True
+            self.string_chars = []
+        elif char in '{[':
+            self.depth += 1
+            if self.depth == 1 and char == '{':
+                self.expecting = "key"
+        elif char in '}]':
+            self.depth -= 1
+            if self.depth == 0:
+                self.complete = True
+        elif self.depth == 1 and char == ':':
+            self.expecting = "value"
+        elif self.depth == 1 and char == ',':
+            self.expecting = "key"
+
+    def end_top_level_string(self):
+        # Decode the escapes of the raw string
+        try:
+            value = json.loads('"' + ''.join(self.string_chars) + '"', strict=False)
+        except json.JSONDecodeError:
+            value = ''.join(self.string_chars)
+
+        if self.expecting == "key":
+            self.current_key = value
+        elif self.expecting == "value" and self.current_key is not None:
+            self.fields[self.current_key] = value
+            if self.on_field:
+                self.on_field(self.current_key, value)
+            self.expecting = None
+
+    def document(self):
+        """Text of the JSON value received so far."""
+        return ''.join(self.text)
@@ -1,9 +1,28 @@
+import argparse
+import hashlib
 import json
 import os
+import re
 from docx import Document
-from docx2pdf import convert
 import glob
+from docx.oxml import parse_xml
+from docx.oxml.ns import nsdecls, qn
 from docx.shared import Inches
+from io import BytesIO
+from lxml import etree
+from PIL import Image
+
+# Extensions of the question images in output_0_areas
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.bmp', '.tiff', '.webp')
+
+# Rendered questions, by hash of their JSON and image, reused when only some answers change
+FRAGMENTS_FOLDER = os.path.join('output_2_docx_pdf', 'fragments')
+
+# Relationship id left in the cached fragments in place of the one of the image
+IMAGE_PLACEHOLDER = "rIdQuestionImage"
+
+# Name of the crops saved by p1_prepare_inputs.py
+QUESTION_NAME = re.compile(r'output_page_(\d+)_area_(\d+)$')
 
 def find_image_matching_json(json_name, search_directory):
     # Strip the .json extension to get the base name
@@ -14,7 +33,7 @@ def find_image_matching_json(json_name, search_directory):
     
     # Use glob to find files matching the pattern
     for filename in glob.glob(pattern):
-        if filename.lower().endswith(('.png', '.jpg', '.jpeg', '.gif', '.bmp', '.tiff')):
+        if filename.lower().endswith(IMAGE_EXTENSIONS):
             return filename  # Return the first matching image found
     
     return None  # No matching image found
@@ -25,15 +44,56 @@ def load_json_data(file_path):
         return json.load(file)
 
 def create_pdf_from_docx(docx_path):
-    """Convert a .docx file to PDF (may require admin permisions)."""
+    """Convert a .docx file to PDF with Word (may require admin permisions)."""
+    # Only needed for this conversion, which is not possible without Word
+    from docx2pdf import convert
     convert(docx_path)
 
-def add_data_docx(data, doc, file_name):
+def picture_source(image_filename):
+    """The image as accepted by python-docx: Word documents can't embed WebP, so it is converted to PNG."""
+    if not image_filename.lower().endswith('.webp'):
+        return image_filename
+    png_image = BytesIO()
+    Image.open(image_filename).save(png_image, format='PNG')
+    png_image.seek(0)
+    return png_image
+
+def question_order(name):
+    """Sort key of a question: page and area of its crop (names that don't follow the pattern go last, by name)."""
+    match = QUESTION_NAME.search(name)
+    if match:
+        return (0, int(match.group(1)), int(match.group(2)), name)
+    return (1, 0, 0, name)
+
+def build_index(jsons_folder, images_folder):
+    """List the questions as (JSON path, image path), reading each folder only once, in the order of the pages and areas."""
+    images = {}
+    if os.path.exists(images_folder):
+        for entry in os.scandir(images_folder):
+            base_name, extension = os.path.splitext(entry.name)
+            if extension.lower() in IMAGE_EXTENSIONS:
+                images.setdefault(base_name, entry.path)
+
+    questions = []
+    for entry in os.scandir(jsons_folder):
+        if not entry.name.endswith('.json'):
+            continue
+        image_path = images.get(entry.name[:-len('.json')])
+        if image_path is None:
+            # Left from an area that was removed since it was solved
+            print(f"Skipping {entry.name}: its image is not in {images_folder}")
+            continue
+        questions.append((entry.path, image_path))
+
+    return sorted(questions, key=lambda question: question_order(os.path.basename(question[0])[:-len('.json')]))
+
+def add_data_docx(data, doc, file_name, image_filename=None):
     """Add content from JSON data to a .docx file."""
 
     # Add original picture of questions
-    image_filename = find_image_matching_json(file_name, "output_0_areas")
-    doc.add_picture(image_filename, width=Inches(5.5))
+    if image_filename is None:
+        image_filename = find_image_matching_json(file_name, "output_0_areas")
+    doc.add_picture(picture_source(image_filename), width=Inches(5.5))
 
     # Add content from JSON
 
@@ -59,9 +119,98 @@ def add_data_docx(data, doc, file_name):
 
         doc.add_paragraph('Alternatica correta: ' + data['resposta']['alternativaCorreta'])
 
+def fragment_key(json_bytes, image_path):
+    """Hash of everything a rendered question depends on: its JSON and its image (by size and modification time)."""
+    digest = hashlib.sha256(json_bytes)
+    if image_path:
+        stat = os.stat(image_path)
+        digest.update(f"{os.path.basename(image_path)}|{stat.st_size}|{stat.st_mtime_ns}".encode())
+    return digest.hexdigest()
+
+def render_fragment(json_bytes, file_name, image_path):
+    """Render one question in a document of its own and return its body as XML, with a placeholder for the image."""
+    doc = Document()
+    add_data_docx(json.loads(json_bytes), doc, file_name, image_path)
+
+    body = doc.element.body
+    for blip in body.iter(qn('a:blip')):
+        blip.set(qn('r:embed'), IMAGE_PLACEHOLDER)
+
+    children = ''.join(etree.tostring(child, encoding='unicode') for child in body if child.tag != qn('w:sectPr'))
+    return f'<w:body {nsdecls("w")}>{children}</w:body>'
+
+def load_fragment(json_path, image_path, rebuild=False):
+    """Return (fragment key, XML) of a question, from the fragment cache if it did not change, and whether it was rendered."""
+    with open(json_path, 'rb') as file:
+        json_bytes = file.read()
+    key = fragment_key(json_bytes, image_path)
+    fragment_path = os.path.join(FRAGMENTS_FOLDER, key + ".xml")
+
+    if not rebuild and os.path.exists(fragment_path):
+        with open(fragment_path, 'r', encoding='utf-8') as file:
+            return key, file.read(), False
+
+    xml = render_fragment(json_bytes, os.path.basename(json_path), image_path)
+    with open(fragment_path, 'w', encoding='utf-8') as file:
+        file.write(xml)
+    return key, xml, True
+
+def append_fragment(doc, xml, image_path, picture_ids):
+    """Copy a rendered question into the document, embedding its image (once per identical image)."""
+    body = doc.element.body
+    fragment = parse_xml(xml)
+
+    if image_path:
+        relationship_id, _ = doc.part.get_or_add_image(picture_source(image_path))
+        for blip in fragment.iter(qn('a:blip')):
+            blip.set(qn('r:embed'), relationship_id)
+
+    # Each picture needs an id of its own in the document
+    for picture in fragment.iter(qn('wp:docPr')):
+        picture.set('id', str(next(picture_ids)))
+
+    for child in list(fragment):
+        body.sectPr.addprevious(child)
+
+def build_docx(jsons_folder, images_folder, docx_path, rebuild=False):
+    """Assemble the document from the question fragments, rendering only the questions that changed since the last run."""
+    if not os.path.exists(FRAGMENTS_FOLDER):
+        os.makedirs(FRAGMENTS_FOLDER)
+
+    questions = build_index(jsons_folder, images_folder)
+    doc = Document()
+    picture_ids = iter(range(1, 10 ** 9))
+    used_fragments = set()
+    rendered = 0
+
+    for i, (json_path, image_path) in enumerate(questions):
+        key, xml, was_rendered = load_fragment(json_path, image_path, rebuild)
+        used_fragments.add(key + ".xml")
+        rendered += was_rendered
+
+        append_fragment(doc, xml, image_path, picture_ids)
+
+        # Add page break only if it is not the last one
+        if i < len(questions) - 1:
+            doc.add_page_break()
+
+    doc.save(docx_path)
+    print(f"Rendered {rendered} of {len(questions)} questions, the others were reused from {FRAGMENTS_FOLDER}.")
+
+    # Fragments of questions that changed or were removed are not needed anymore
+    for file_name in os.listdir(FRAGMENTS_FOLDER):
+        if file_name not in used_fragments:
+            os.remove(os.path.join(FRAGMENTS_FOLDER, file_name))
+
 
 if __name__ == "__main__":
 
+    parser = argparse.ArgumentParser(description="Assemble the question JSONs into one document.")
+    parser.add_argument("--rebuild", action="store_true", help="render every question again instead of reusing the unchanged ones")
+    parser.add_argument("--pdf", choices=["native", "libreoffice", "word", "none"], default="native",
+                        help="how to create the PDF: written directly from the JSONs (default), converted from the docx by LibreOffice or Word, or not at all")
+    args = parser.parse_args()
+
 
     # Define JSON folder
     jsons_folder = 'output_1_jsons'
@@ -72,34 +221,33 @@ if __name__ == "__main__":
         os.makedirs(output_folder)
 
 
-    # Create and docx
+    # Create the docx, one fragment per question
     docx_path = os.path.join(output_folder, 'questions.docx')
-    doc = Document()
-  
-    # Iterate over each JSON file in the directory
-    for file_name in os.listdir(jsons_folder):
-        if file_name.endswith('.json'):
-            file_path = os.path.join(jsons_folder, file_name)
-            data = load_json_data(file_path)
-            
-            # Create docx
-            add_data_docx(data, doc, file_name)
-
-            # Add page break only if it is not the last one
-            if file_name != os.listdir(jsons_folder)[-1]:
-                doc.add_page_break()
-
-    # Save .docx document
-    doc.save(docx_path)
-    print("\nThe docx file was saved.")
+    build_docx(jsons_folder, 'output_0_areas', docx_path, args.rebuild)
 
-    # Check if there is Word installed to convert docx to pdf
-    print("\nIn order to convert docx to pdf, with the docx2pdf library, it is required to have Word installed.\n")
-    word_check = input("Is Word installed in this computer (y for Yes)? ")
+    print("\nThe docx file was saved.")
 
-    if word_check.lower() == "y":
-        print("To convert docx to pdf, Word may open to ask for permission.")
-        # Save the .pdf converted from .docx
-        create_pdf_from_docx(docx_path)
-    else:
-        print("Unable to convert docx to pdf.")
\ No newline at end of file
+    # Import here: the PDF export imports this module
+    from p3_pdf_export import convert_with_libreoffice, export_pdf
+
+    if args.pdf == "native":
+        # Written straight from the JSONs and images, without Word
+        pdf_path = os.path.join(output_folder, 'questions.pdf')
+        export_pdf(jsons_folder, 'output_0_areas', pdf_path, args.rebuild)
+        print("\nThe pdf file was saved.")
+
+    elif args.pdf == "libreoffice":
+        convert_with_libreoffice(docx_path)
+        print("\nThe pdf file was saved.")
+
+    elif args.pdf == "word":
+        # Check if there is Word installed to convert docx to pdf
+        print("\nIn order to convert docx to pdf, with the docx2pdf library, it is required to have Word installed.\n")
+        word_check = input("Is Word installed in this computer (y for Yes)? ")
+
+        if word_check.lower() == "y":
+            print("To convert docx to pdf, Word may open to ask for permission.")
+            # Save the .pdf converted from .docx
+            create_pdf_from_docx(docx_path)
+        else:
+            print("Unable to convert docx to pdf.")
@@ -0,0 +1,156 @@
+import concurrent.futures
+import hashlib
+import os
+import shutil
+import subprocess
+
+import matplotlib
+import pikepdf
+from fpdf import FPDF
+from PIL import Image
+
+import p0_configuration as configuration
+from p3_jsons_converter import build_index, fragment_key, load_json_data
+
+# Questions rendered by each process before the chunks are merged into one PDF
+PDF_CHUNK_SIZE = getattr(configuration, "PDF_CHUNK_SIZE", 50)
+
+# Processes rendering the chunks (None for all cores)
+PDF_WORKERS = getattr(configuration, "PDF_WORKERS", None)
+
+# TrueType fonts with the accents of Portuguese (the ones shipped with matplotlib by default)
+FONTS_FOLDER = os.path.join(matplotlib.get_data_path(), 'fonts', 'ttf')
+PDF_FONT_PATH = getattr(configuration, "PDF_FONT_PATH", None) or os.path.join(FONTS_FOLDER, 'DejaVuSans.ttf')
+PDF_BOLD_FONT_PATH = getattr(configuration, "PDF_BOLD_FONT_PATH", None) or os.path.join(FONTS_FOLDER, 'DejaVuSans-Bold.ttf')
+
+# Rendered chunks, by hash of their questions, reused when only some answers change
+CHUNKS_FOLDER = os.path.join('output_2_docx_pdf', 'chunks')
+
+# Same width of the question picture as in the docx, in mm
+PICTURE_WIDTH = 5.5 * 25.4
+
+FONT_SIZE = 11
+LINE_HEIGHT = 6
+
+
+def new_pdf():
+    pdf = FPDF(format='A4')
+    pdf.set_auto_page_break(True, margin=20)
+    pdf.add_font("Questions", "", PDF_FONT_PATH)
+    pdf.add_font("Questions", "B", PDF_BOLD_FONT_PATH)
+    return pdf
+
+
+def add_paragraph(pdf, text, bold=False):
+    pdf.set_font("Questions", "B" if bold else "", FONT_SIZE)
+    pdf.multi_cell(0, LINE_HEIGHT, text, new_x="LMARGIN", new_y="NEXT")
+
+
+def add_picture(pdf, image_path):
+    # Tall crops are narrowed to fit in one page
+    with Image.open(image_path) as image:
+        width, height = image.size
+    picture_width = min(PICTURE_WIDTH, pdf.epw, pdf.eph * width / height)
+
+    # JPEG crops are embedded as they are, without being decoded and compressed again
+    pdf.image(image_path, w=picture_width)
+    pdf.ln(LINE_HEIGHT / 2)
+
+
+def add_data_pdf(data, pdf, image_path):
+    """Add one question to the PDF, with the same content as add_data_docx."""
+    pdf.add_page()
+
+    # Add original picture of questions
+    if image_path:
+        add_picture(pdf, image_path)
+
+    add_paragraph(pdf, data['enunciado'], bold=True)
+
+    if data['tipo'] == "Discursiva":
+        add_paragraph(pdf, data['resposta'])
+    if data['tipo'] == "Objetiva":
+        alternatives = [(key, value) for key, value in data['resposta'].items() if key != "alternativaCorreta"]
+        for key, value in alternatives:
+            add_paragraph(pdf, key.upper() + ')  ' + value['alternativa'], bold=True)
+
+        pdf.ln(LINE_HEIGHT)
+
+        for key, value in alternatives:
+            add_paragraph(pdf, key.upper() + ')  ' + value['alternativa'] + ' ' + value['textoExplicativo'])
+
+        pdf.ln(LINE_HEIGHT)
+
+        add_paragraph(pdf, 'Alternativa correta: ' + data['resposta']['alternativaCorreta'])
+
+
+def render_chunk(questions, pdf_path):
+    """Render a list of (JSON path, image path) into a PDF of its own. Run in the process pool."""
+    pdf = new_pdf()
+    for json_path, image_path in questions:
+        add_data_pdf(load_json_data(json_path), pdf, image_path)
+
+    # Write under another name first, so an interrupted run never leaves a broken chunk to be reused
+    pdf.output(pdf_path + ".tmp")
+    os.replace(pdf_path + ".tmp", pdf_path)
+    return pdf_path
+
+
+def chunk_key(questions):
+    """Hash of the questions of a chunk, by the same key as the docx fragments."""
+    digest = hashlib.sha256()
+    for json_path, image_path in questions:
+        with open(json_path, 'rb') as file:
+            digest.update(fragment_key(file.read(), image_path).encode())
+    digest.update(f"{PDF_FONT_PATH}|{PDF_BOLD_FONT_PATH}".encode())
+    return digest.hexdigest()
+
+
+def export_pdf(jsons_folder, images_folder, pdf_path, rebuild=False, workers=PDF_WORKERS):
+    """Write the PDF of all questions without Word: chunks of PDF_CHUNK_SIZE questions are rendered in parallel and merged."""
+    if not os.path.exists(CHUNKS_FOLDER):
+        os.makedirs(CHUNKS_FOLDER)
+
+    questions = build_index(jsons_folder, images_folder)
+    chunks = [questions[i:i + PDF_CHUNK_SIZE] for i in range(0, len(questions), PDF_CHUNK_SIZE)]
+    chunk_paths = [os.path.join(CHUNKS_FOLDER, chunk_key(chunk) + ".pdf") for chunk in chunks]
+
+    # Only the chunks with new or changed questions are rendered
+    changed = [(chunk, chunk_path) for chunk, chunk_path in zip(chunks, chunk_paths) if rebuild or not os.path.exists(chunk_path)]
+    print(f"Rendering {len(changed)} of {len(chunks)} chunks of up to {PDF_CHUNK_SIZE} questions...")
+
+    if workers == 1:
+        # Already in a worker process (e.g. of scheduler.py)
+        for chunk, chunk_path in changed:
+            render_chunk(chunk, chunk_path)
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(render_chunk, chunk, chunk_path) for chunk, chunk_path in changed]
+            for future in concurrent.futures.as_completed(futures):
+                future.result()
+
+    # Merge the chunks, copying their pages without rendering them again (the chunks are read lazily, until the save)
+    chunk_pdfs = [pikepdf.Pdf.open(chunk_path) for chunk_path in chunk_paths]
+    try:
+        with pikepdf.Pdf.new() as merged:
+            for chunk_pdf in chunk_pdfs:
+                merged.pages.extend(chunk_pdf.pages)
+            merged.save(pdf_path)
+    finally:
+        for chunk_pdf in chunk_pdfs:
+            chunk_pdf.close()
+
+    # Chunks of questions that changed or were removed are not needed anymore
+    used_chunks = set(os.path.basename(chunk_path) for chunk_path in chunk_paths)
+    for file_name in os.listdir(CHUNKS_FOLDER):
+        if file_name not in used_chunks:
+            os.remove(os.path.join(CHUNKS_FOLDER, file_name))
+
+
+def convert_with_libreoffice(docx_path):
+    """Convert the docx to PDF with LibreOffice in headless mode (no interface or prompt)."""
+    soffice = shutil.which("soffice") or shutil.which("libreoffice")
+    if soffice is None:
+        raise FileNotFoundError("LibreOffice (soffice) was not found")
+    subprocess.run([soffice, "--headless", "--convert-to", "pdf", "--outdir", os.path.dirname(docx_path) or ".", docx_path],
+                   check=True, stdout=subprocess.DEVNULL)
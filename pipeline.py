@@ -0,0 +1,204 @@
+"""Run the three stages at once: each question area is sent to the API as soon as it is saved, and rendered as soon as it is solved.
+
+The stages are chained by bounded queues. Cropping runs on the main thread (the selection interface needs it), a pool of
+MAX_WORKERS threads solves the crops, and one thread renders the solved questions into docx fragments. When the last crop
+is solved, the document is assembled from the fragments and the PDF is written, so the run takes about as long as the
+slowest stage instead of the sum of the three.
+"""
+import argparse
+import os
+import queue
+import threading
+import time
+
+import p0_configuration as configuration
+import p2_main
+from p1_prepare_inputs import add_arguments, prepare_inputs
+from p2_journal import JOURNAL_PATH, MAX_RETRIES, JobJournal
+from p2_metrics import METRICS_CSV_PATH, METRICS_JSON_PATH, get_shared_metrics, print_summary
+from p3_jsons_converter import FRAGMENTS_FOLDER, build_docx, find_image_matching_json, load_fragment
+
+# Crops (and solved questions) waiting for the next stage. When a queue is full the stage before it waits, so a slow API
+# holds back the cropping instead of piling up work in memory
+PIPELINE_QUEUE_SIZE = getattr(configuration, "PIPELINE_QUEUE_SIZE", 32)
+
+IMAGES_FOLDER = 'output_0_areas'
+JSONS_FOLDER = 'output_1_jsons'
+OUTPUT_FOLDER = 'output_2_docx_pdf'
+
+# Put in a queue to stop the threads reading it
+STOP = None
+
+
+class Pipeline:
+    """Queues and threads between the stages, with the counts of what went through each one."""
+
+    def __init__(self, journal, solvers=p2_main.MAX_WORKERS, queue_size=PIPELINE_QUEUE_SIZE, retry_failed=False):
+        self.journal = journal
+        self.retry_failed = retry_failed
+        self.crops = queue.Queue(maxsize=queue_size)
+        self.solved = queue.Queue(maxsize=queue_size)
+        self.lock = threading.Lock()
+        self.submitted = set()
+        self.failed = []
+        self.rendered = 0
+        self.stage_seconds = {}
+        self.cancelled = False
+
+        self.solvers = [threading.Thread(target=self.solve, name=f"solver-{i}", daemon=True) for i in range(solvers)]
+        self.renderer = threading.Thread(target=self.render, name="renderer", daemon=True)
+        for thread in self.solvers + [self.renderer]:
+            thread.start()
+
+    def submit(self, image_file):
+        """Called by the cropping stage with each saved area (also from its saving threads)."""
+        with self.lock:
+            # An area saved twice (a page selected again) is solved again: the journal sees the new signature
+            self.submitted.add(image_file)
+        self.crops.put(image_file)
+
+    def solve(self):
+        while True:
+            image_file = self.crops.get()
+            if image_file is STOP:
+                return
+            if self.cancelled:
+                continue
+
+            # Areas solved in an earlier run, and not changed since, go straight to the rendering (the duplicates of solved
+            # questions are answered by solve_with_retries)
+            remaining = self.journal.files_to_process([image_file], self.retry_failed)
+            if remaining:
+                try:
+                    p2_main.solve_with_retries(image_file, self.journal)
+                except Exception:
+                    with self.lock:
+                        self.failed.append(image_file)
+                    continue
+
+            self.solved.put(image_file)
+
+    def render(self):
+        while True:
+            image_file = self.solved.get()
+            if image_file is STOP:
+                return
+            if self.cancelled:
+                continue
+
+            json_path = os.path.join(JSONS_FOLDER, p2_main.image_name(image_file) + ".json")
+            if not os.path.exists(json_path):
+                continue
+            try:
+                # Kept in the fragment cache, so the final assembly only has to copy it
+                _, _, was_rendered = load_fragment(json_path, find_image_matching_json(os.path.basename(json_path), IMAGES_FOLDER))
+                self.rendered += was_rendered
+            except Exception as e:
+                print(f"\nError rendering {json_path}: {e}\n")
+
+    def finish_solving(self):
+        for _ in self.solvers:
+            self.crops.put(STOP)
+        for thread in self.solvers:
+            thread.join()
+
+    def finish_rendering(self):
+        self.solved.put(STOP)
+        self.renderer.join()
+
+    def cancel(self):
+        """Stop the threads without solving or rendering what is still queued (the requests already being made are finished)."""
+        self.cancelled = True
+        for work_queue, threads in ((self.crops, self.solvers), (self.solved, [self.renderer])):
+            for _ in threads:
+                work_queue.put(STOP)
+            for thread in threads:
+                thread.join()
+
+
+def run_pipeline(folder_path='inputs', dpi=None, prefetch=None, detect=False, review=True, workers=None, replay=False,
+                 solvers=p2_main.MAX_WORKERS, pdf="native", retry_failed=False, rebuild=False):
+    """Crop, solve and render the questions of folder_path in one overlapped run. Return the images that failed."""
+    for folder in (IMAGES_FOLDER, JSONS_FOLDER, OUTPUT_FOLDER, FRAGMENTS_FOLDER):
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+
+    metrics = get_shared_metrics()
+    journal = JobJournal(JOURNAL_PATH, listener=metrics.journal_record)
+    # The number of crops is only known at the end of the cropping
+    metrics.start(None)
+    pipeline = Pipeline(journal, solvers, retry_failed=retry_failed)
+
+    start_time = time.perf_counter()
+    crop_options = {name: value for name, value in (("dpi", dpi), ("prefetch", prefetch)) if value is not None}
+    try:
+        prepare_inputs(folder_path, IMAGES_FOLDER, detect=detect, review=review, workers=workers, replay=replay,
+                       on_area_saved=pipeline.submit, **crop_options)
+        pipeline.stage_seconds["crop"] = time.perf_counter() - start_time
+
+        # Areas cropped in an earlier run (e.g. pages left unchanged by a replay) are solved too if they were not yet
+        for image_file in p2_main.list_image_files(IMAGES_FOLDER):
+            if image_file not in pipeline.submitted:
+                pipeline.submit(image_file)
+
+        pipeline.finish_solving()
+        pipeline.stage_seconds["solve"] = time.perf_counter() - start_time
+        pipeline.finish_rendering()
+    except BaseException:
+        # Interrupted or failed: nothing more is sent to the API
+        pipeline.cancel()
+        raise
+    finally:
+        journal.close()
+        metrics.close()
+
+    # The fragments are ready: the document only has to be assembled
+    docx_path = os.path.join(OUTPUT_FOLDER, 'questions.docx')
+    build_docx(JSONS_FOLDER, IMAGES_FOLDER, docx_path, rebuild)
+    print("\nThe docx file was saved.")
+
+    if pdf == "native":
+        from p3_pdf_export import export_pdf
+        export_pdf(JSONS_FOLDER, IMAGES_FOLDER, os.path.join(OUTPUT_FOLDER, 'questions.pdf'), rebuild)
+        print("\nThe pdf file was saved.")
+    elif pdf == "libreoffice":
+        from p3_pdf_export import convert_with_libreoffice
+        convert_with_libreoffice(docx_path)
+        print("\nThe pdf file was saved.")
+    pipeline.stage_seconds["render"] = time.perf_counter() - start_time
+
+    print(f"\nJournal: {journal.summary()}")
+    print_summary(metrics.export())
+    print(f"Metrics saved in {METRICS_JSON_PATH} and {METRICS_CSV_PATH}")
+    print(f"Cropping finished after {pipeline.stage_seconds['crop']:.1f}s, solving after {pipeline.stage_seconds['solve']:.1f}s"
+          f" and the documents after {pipeline.stage_seconds['render']:.1f}s ({pipeline.rendered} questions rendered while solving)")
+
+    if pipeline.failed:
+        print(f"\n\nThere were {len(pipeline.failed)} images that failed {MAX_RETRIES} times. Run again with --retry-failed to try them again.\n")
+
+    if p2_main.USE_CACHE:
+        p2_main.get_shared_cache().report()
+
+    return pipeline.failed
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Select, solve and assemble the questions of the files in inputs, with the stages overlapped.")
+    add_arguments(parser)
+    parser.add_argument("--solvers", type=int, default=p2_main.MAX_WORKERS, help="threads making the API calls")
+    parser.add_argument("--stream", action="store_true", help="receive the answers as a stream, saving each 'enunciado' as soon as it arrives")
+    parser.add_argument("--no-cache", action="store_true", help="always call the API, even for images that were already solved")
+    parser.add_argument("--dedup", action="store_true", help="reuse the answer of an already solved question for crops that look the same")
+    parser.add_argument("--retry-failed", action="store_true", help="also retry the images that already failed MAX_RETRIES times")
+    parser.add_argument("--rebuild", action="store_true", help="render every question again instead of reusing the unchanged ones")
+    parser.add_argument("--pdf", choices=["native", "libreoffice", "none"], default="native",
+                        help="how to create the PDF: written directly from the JSONs (default), converted from the docx by LibreOffice, or not at all")
+    args = parser.parse_args()
+
+    p2_main.USE_CACHE = p2_main.USE_CACHE and not args.no_cache
+    p2_main.USE_STREAM = p2_main.USE_STREAM or args.stream
+    p2_main.USE_DEDUP = p2_main.USE_DEDUP or args.dedup
+
+    run_pipeline('inputs', args.dpi, args.prefetch, args.auto or args.headless, not args.headless, args.workers, args.replay,
+                 args.solvers, args.pdf, args.retry_failed, args.rebuild)
@@ -0,0 +1,222 @@
+"""Process many exams at once, each in a workspace of its own, sharing one API quota.
+
+A workspace is a folder with an `inputs` folder, where the usual outputs (output_0_areas, output_1_jsons, api_responses,
+output_2_docx_pdf) are written. Each exam goes through three stages:
+
+1. crop: the areas are detected without review (or replayed from inputs/annotations.json), in the shared process pool;
+2. solve: pipeline.py solves the crops and assembles the docx, in a process of its own, with its API calls counted against
+   the rate budget of the scheduler, which gives it in turns to the exams that are waiting;
+3. pdf: the native PDF is written, in the shared process pool.
+
+While an exam waits for the API, the others use the cores for their crops and PDFs.
+"""
+import argparse
+import concurrent.futures
+import contextlib
+import json
+import os
+import secrets
+import shutil
+import subprocess
+import sys
+import threading
+import time
+
+import p0_configuration as configuration
+from p2_rate_limiter import serve_rate_budgets
+
+# Exams solving at the same time (they share the API quota, so more of them mostly means more waiting)
+SCHEDULER_MAX_JOBS = getattr(configuration, "SCHEDULER_MAX_JOBS", 4)
+
+# Processes for the crops and PDFs of all the exams (None for all cores)
+SCHEDULER_CPU_WORKERS = getattr(configuration, "SCHEDULER_CPU_WORKERS", None)
+
+REPO_FOLDER = os.path.dirname(os.path.abspath(__file__))
+
+# State of the jobs, rewritten in the folder of the workspaces whenever it changes
+STATUS_FILE = "scheduler_status.json"
+
+WAITING = "waiting"
+CROPPING = "cropping"
+SOLVING = "solving"
+RENDERING = "rendering"
+FINISHED = "finished"
+FAILED = "failed"
+
+
+def crop_exam(workspace, replay):
+    """Crop the areas of one exam. Run in the process pool, whose processes only run one task at a time."""
+    from p1_prepare_inputs import prepare_inputs
+
+    # The paths of the scripts are relative to the workspace
+    os.chdir(workspace)
+    with open('job.log', 'a') as log, contextlib.redirect_stdout(log):
+        prepare_inputs('inputs', 'output_0_areas', detect=True, review=False, workers=1, replay=replay)
+    return len(os.listdir('output_0_areas'))
+
+
+def export_exam_pdf(workspace):
+    """Write the PDF of one exam, in the process pool."""
+    from p3_pdf_export import export_pdf
+
+    os.chdir(workspace)
+    with open('job.log', 'a') as log, contextlib.redirect_stdout(log):
+        export_pdf('output_1_jsons', 'output_0_areas', os.path.join('output_2_docx_pdf', 'questions.pdf'), workers=1)
+
+
+class ExamJob:
+    """One exam: its workspace, the stage it is in and how long each stage took."""
+
+    def __init__(self, workspace):
+        self.workspace = os.path.abspath(workspace)
+        self.name = os.path.basename(self.workspace)
+        self.state = WAITING
+        self.seconds = {}
+        self.crops = None
+        self.summary = None
+        self.error = None
+
+    @classmethod
+    def create(cls, root, name, files):
+        """Make a workspace for a new exam in root, with a copy of its input files."""
+        inputs = os.path.join(root, name, 'inputs')
+        os.makedirs(inputs, exist_ok=True)
+        for file in files:
+            shutil.copy(file, inputs)
+        return cls(os.path.join(root, name))
+
+    def path(self, *parts):
+        return os.path.join(self.workspace, *parts)
+
+    def status(self):
+        return {"name": self.name, "workspace": self.workspace, "state": self.state, "crops": self.crops,
+                "seconds": {stage: round(seconds, 1) for stage, seconds in self.seconds.items()},
+                "summary": self.summary, "error": self.error}
+
+
+def find_jobs(root):
+    """Every folder of root with an inputs folder is an exam."""
+    return [ExamJob(os.path.join(root, name)) for name in sorted(os.listdir(root))
+            if os.path.isdir(os.path.join(root, name, 'inputs'))]
+
+
+class Scheduler:
+    """Runs the jobs through their stages, with one process pool and one rate budget for all of them."""
+
+    def __init__(self, root, jobs, max_jobs=SCHEDULER_MAX_JOBS, cpu_workers=SCHEDULER_CPU_WORKERS, pdf=True, pipeline_args=()):
+        self.root = root
+        self.jobs = jobs
+        self.pdf = pdf
+        self.pipeline_args = list(pipeline_args)
+        self.solving_slots = threading.Semaphore(max_jobs)
+        self.cpu_pool = concurrent.futures.ProcessPoolExecutor(max_workers=cpu_workers)
+        self.status_lock = threading.Lock()
+
+        # The pipelines of the jobs connect to these budgets (one per model) instead of each using the whole quota
+        self.authkey = secrets.token_bytes(16)
+        self.budget_address = serve_rate_budgets(self.authkey)
+
+    def set_state(self, job, state, error=None):
+        with self.status_lock:
+            job.state = state
+            job.error = error
+            print(f"[{job.name}] {state}" + (f": {error}" if error else ""))
+
+            statuses = [job.status() for job in self.jobs]
+            with open(os.path.join(self.root, STATUS_FILE + ".tmp"), 'w') as file:
+                json.dump({"jobs": statuses}, file, indent=4)
+            os.replace(os.path.join(self.root, STATUS_FILE + ".tmp"), os.path.join(self.root, STATUS_FILE))
+
+    def timed(self, job, stage, function, *args):
+        start_time = time.perf_counter()
+        try:
+            return function(*args)
+        finally:
+            job.seconds[stage] = time.perf_counter() - start_time
+
+    def solve(self, job):
+        """Run pipeline.py in the workspace: the crops are already saved, so its replay only submits them to the API."""
+        environment = dict(os.environ, RATE_BUDGET_ADDRESS=self.budget_address, RATE_BUDGET_AUTHKEY=self.authkey.hex(),
+                           RATE_BUDGET_JOB=job.name)
+        with open(job.path('job.log'), 'a') as log:
+            process = subprocess.run([sys.executable, os.path.join(REPO_FOLDER, 'pipeline.py'), '--replay', '--pdf', 'none',
+                                      *self.pipeline_args],
+                                     cwd=job.workspace, env=environment, stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT)
+        if process.returncode != 0:
+            raise RuntimeError(f"pipeline.py exited with code {process.returncode}, see {job.path('job.log')}")
+
+        metrics_path = job.path('api_responses', 'metrics.json')
+        if os.path.exists(metrics_path):
+            with open(metrics_path, 'r') as file:
+                metrics = json.load(file)
+            job.summary = {name: metrics[name] for name in ("images_done", "images_failed", "requests", "cost_usd")}
+
+    def run_job(self, job):
+        try:
+            self.set_state(job, CROPPING)
+            replay = os.path.exists(job.path('inputs', 'annotations.json'))
+            job.crops = self.timed(job, "crop", lambda: self.cpu_pool.submit(crop_exam, job.workspace, replay).result())
+
+            with self.solving_slots:
+                self.set_state(job, SOLVING)
+                self.timed(job, "solve", self.solve, job)
+
+            if self.pdf:
+                self.set_state(job, RENDERING)
+                self.timed(job, "pdf", lambda: self.cpu_pool.submit(export_exam_pdf, job.workspace).result())
+
+            self.set_state(job, FINISHED)
+        except Exception as e:
+            self.set_state(job, FAILED, str(e))
+
+    def run(self):
+        """Run all the jobs. Return the ones that failed."""
+        threads = [threading.Thread(target=self.run_job, args=(job,), name=job.name) for job in self.jobs]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.cpu_pool.shutdown()
+        return [job for job in self.jobs if job.state == FAILED]
+
+
+def print_jobs(jobs):
+    print("\nExams:")
+    for job in jobs:
+        times = ", ".join(f"{stage} {seconds:.1f}s" for stage, seconds in job.seconds.items())
+        summary = job.summary or {}
+        print(f"  {job.name}: {job.state}, {job.crops} crops, {summary.get('images_done')} solved, "
+              f"{summary.get('requests')} requests, ${summary.get('cost_usd', 0):.2f} ({times})")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Crop, solve and render many exams at once, each in a workspace (a folder with an inputs folder).")
+    parser.add_argument("root", help="folder with one workspace per exam")
+    parser.add_argument("--jobs", nargs="+", default=None, help="names of the workspaces to run (default: all of them)")
+    parser.add_argument("--new", nargs="+", metavar=("NAME", "FILE"), default=None, help="create the workspace NAME with the given input files, and run it")
+    parser.add_argument("--max-jobs", type=int, default=SCHEDULER_MAX_JOBS, help="exams solving at the same time")
+    parser.add_argument("--cpu-workers", type=int, default=SCHEDULER_CPU_WORKERS, help="processes for the crops and PDFs of all exams (default: all cores)")
+    parser.add_argument("--no-pdf", action="store_true", help="only create the docx of each exam")
+    parser.add_argument("--pipeline-args", default="", help="extra arguments of pipeline.py, e.g. --pipeline-args=\"--solvers 4\"")
+    args = parser.parse_args()
+
+    os.makedirs(args.root, exist_ok=True)
+    if args.new:
+        jobs = [ExamJob.create(args.root, args.new[0], args.new[1:])]
+    else:
+        jobs = find_jobs(args.root)
+        if args.jobs:
+            jobs = [job for job in jobs if job.name in args.jobs]
+
+    if not jobs:
+        print(f"No workspace with an inputs folder was found in {args.root}.")
+        sys.exit()
+
+    print(f"Running {len(jobs)} exams, {args.max_jobs} solving at a time...")
+    scheduler = Scheduler(args.root, jobs, args.max_jobs, args.cpu_workers, not args.no_pdf, args.pipeline_args.split())
+    failed_jobs = scheduler.run()
+    print_jobs(jobs)
+
+    if failed_jobs:
+        print(f"\n{len(failed_jobs)} exams failed, see the job.log of their workspaces.")